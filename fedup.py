@@ -24,7 +24,14 @@ from subprocess import call
 
 from fedup.download import UpgradeDownloader, YumBaseError, yum_plugin_for_exc
 from fedup.sysprep import prep_upgrade, prep_boot, setup_media_mount
-from fedup.upgrade import RPMUpgrade, TransactionError
+from fedup.upgrade import RPMUpgrade, TransactionError, test_levels
+from fedup.upgrade import transaction_fingerprint
+from fedup.upgrade import load_test_result, save_test_result
+from fedup.conf import Config
+from fedup.objstore import ObjectStore
+from fedup.hdrcache import HeaderCache
+from fedup.cachebudget import repodirs
+from fedup.util import hrsize, mkdir_p
 
 from fedup.commandline import parse_args, do_cleanup, device_setup
 from fedup import textoutput as output
@@ -38,16 +45,18 @@ def message(m):
     print m
     log.info(m)
 
-from fedup import _, kernelpath, initrdpath
+from fedup import _, kernelpath, initrdpath, cachedir, upgradeconf
 from fedup import version as fedupversion
 
 def setup_downloader(version, instrepo=None, cacheonly=False, repos=[],
-                     enable_plugins=[], disable_plugins=[]):
+                     enable_plugins=[], disable_plugins=[],
+                     lazy_filelists=False):
     log.debug("setup_downloader(version=%s, repos=%s)", version, repos)
     f = UpgradeDownloader(version=version, cacheonly=cacheonly)
     f.preconf.enabled_plugins += enable_plugins
     f.preconf.disabled_plugins += disable_plugins
     f.instrepoid = instrepo
+    f.lazy_filelists = lazy_filelists
     repo_cb = output.RepoCallback()
     repo_prog = output.RepoProgress(fo=sys.stdout)
     multi_prog = output.RepoMultiProgress(fo=sys.stdout)
@@ -62,7 +71,8 @@ def setup_downloader(version, instrepo=None, cacheonly=False, repos=[],
         log.info("disabled repos: " + " ".join(disabled_repos))
     return f
 
-def download_packages(f, add_install=[]):
+def download_packages(f, add_install=[], cache_budget=None,
+                      cache_dryrun=False, skip_diskspace=False):
     updates = f.build_update_transaction(callback=output.DepsolveCallback(f),
                                          add_install=add_install)
     # check for empty upgrade transaction
@@ -79,10 +89,39 @@ def download_packages(f, add_install=[]):
         for p in transprobs:
             print "  " + p
     # clean out any unneeded packages from the cache
-    f.clean_cache(keepfiles=(p.localPkg() for p in updates))
-    # TODO: check disk space > sum(p.size for p in updates)
+    keepfiles = [p.localPkg() for p in updates]
+    if cache_budget is None:
+        f.clean_cache(keepfiles=keepfiles)
+    else:
+        incoming = sum(p.size for p in updates
+                       if not os.path.exists(p.localPkg()))
+        plan = f.budget_cache(keepfiles, cache_budget, incoming, cache_dryrun)
+        if cache_dryrun:
+            for line in plan.report():
+                print line
+            raise SystemExit(0)
+    # make sure it'll all fit before we start downloading
+    plan = f.plan_diskspace(updates)
+    for line in plan.report():
+        log.info("disk space: %s", line)
+    spaceprobs = plan.problems()
+    if spaceprobs:
+        if skip_diskspace:
+            print _("WARNING: the upgrade might not fit:")
+        else:
+            print _("Not enough space for the upgrade:")
+        for line in plan.report():
+            print "  " + line
+        for p in spaceprobs:
+            print "  " + p
+        if not skip_diskspace:
+            print _("Free up some space, or use --skip-diskspace-check "
+                    "if you're sure it'll fit.")
+            raise SystemExit(1)
     # download packages
     f.download_packages(updates, callback=output.DownloadCallback())
+    if f.delta_saved:
+        print _("delta RPMs saved %s of downloads") % hrsize(f.delta_saved)
 
     return updates
 
@@ -111,7 +150,7 @@ def need_product(f):
         log.info("no product in upgrade set")
 
     # Are there any products available?
-    if not check_for_product(f.pkgSack):
+    if not f.repos_whatprovides('system-release-product'):
         # Maybe it's F18->F19, maybe this is a Fedora variant.. who knows?
         log.info("no products in the repos - skipping")
         return False
@@ -121,22 +160,64 @@ def need_product(f):
     log.info("--product is needed")
     return True
 
-def transaction_test(pkgs):
-    print _("testing upgrade transaction")
+def transaction_test(pkgs, force=False, level='full'):
     pkgfiles = set(po.localPkg() for po in pkgs)
+    checksums = dict((po.localPkg(), po.returnIdSum()[1]) for po in pkgs)
+    # skip the test if nothing has changed since the last one
+    fingerprint = transaction_fingerprint(checksums, level=level)
+    conf = Config(upgradeconf)
+    saved = load_test_result(conf, fingerprint)
+    if saved and not force:
+        print _("upgrade transaction unchanged since last test, skipping test")
+        log.info("reusing test result for transaction %s", fingerprint)
+        return saved
+    def save(probs, rv):
+        save_test_result(conf, fingerprint, probs, rv)
+        mkdir_p(os.path.dirname(upgradeconf))
+        conf.write()
+    print _("testing upgrade transaction (%s)") % level
     fu = RPMUpgrade()
-    probs = fu.setup_transaction(pkgfiles=pkgfiles, check_fatal=False)
-    rv = fu.test_transaction(callback=output.TransactionCallback(numpkgs=len(pkgfiles)))
+    fu.hdrcache = HeaderCache(os.path.join(cachedir, 'headers.cache'))
+    try:
+        probs = fu.setup_transaction(pkgfiles=pkgfiles, check_fatal=False,
+                                     checksums=checksums)
+        rv = fu.test_transaction(level=level,
+                  callback=output.TransactionCallback(numpkgs=len(pkgfiles)))
+    except TransactionError as e:
+        # record the failure, so the saved result isn't a stale success.
+        # load_test_result() won't reuse it: things the fingerprint doesn't
+        # cover (like free disk space) might have changed by next time.
+        save(e, 1)
+        raise
+    finally:
+        for l in test_levels:
+            if l in fu.timings:
+                print _("%s check took %.1fs") % (l, fu.timings[l])
+                log.info("%s check took %.3fs", l, fu.timings[l])
+    save(probs, rv)
     return (probs, rv)
 
 def reboot():
     call(['systemctl', 'reboot'])
 
+def cache_stats():
+    store = ObjectStore(os.path.join(cachedir, 'objects'))
+    stats = store.stats(os.path.join(d, 'packages')
+                        for d in repodirs(cachedir))
+    print _("object store: %u packages, %s") % (stats['objects'],
+                                               hrsize(stats['size']))
+    print _("linked from repo caches %u times, saving %s") % (stats['links'],
+                                                      hrsize(stats['saved']))
+
 def main(args):
     if args.clean:
         do_cleanup(args)
         return
 
+    if getattr(args, 'cache_stats', False):
+        cache_stats()
+        return
+
     if args.device or args.iso:
         mnt = device_setup(args)
 
@@ -158,11 +239,22 @@ def main(args):
                          instrepo=args.instrepo,
                          repos=args.repos,
                          enable_plugins=args.enable_plugins,
-                         disable_plugins=args.disable_plugins)
+                         disable_plugins=args.disable_plugins,
+                         lazy_filelists=args.lazy_filelists)
 
     if args.nogpgcheck:
         f._override_sigchecks = True
 
+    f.verify_workers = args.verify_workers
+    f.split_size = args.split_size * 1024 * 1024
+    f.split_count = args.split_count
+    f.download_engine = args.download_engine
+    f.max_connections = args.max_connections
+    f.hedge_after = args.hedge_after
+    f.depsolver = args.depsolver
+    f.dedup = args.dedup
+    f.deltarpm = args.deltarpm
+
     if args.expire_cache:
         print "expiring cache files"
         f.cleanExpireCache()
@@ -195,10 +287,13 @@ def main(args):
         message("skipping package download")
     else:
         print _("setting up update...")
-        if len(f.pkgSack) == 0:
+        if f.repos_empty():
             print("no updates available in configured repos!")
             raise SystemExit(1)
-        pkgs = download_packages(f, add_install=args.add_install)
+        pkgs = download_packages(f, add_install=args.add_install,
+                                 cache_budget=args.cache_budget,
+                                 cache_dryrun=args.cache_dryrun,
+                                 skip_diskspace=args.skip_diskspace)
 
         # Special check to be sure upgrades to F21 have a product
         if args.legacy_fedora and need_product(f):
@@ -207,7 +302,8 @@ def main(args):
             raise SystemExit(1)
 
         # Run a test transaction
-        probs, rv = transaction_test(pkgs)
+        probs, rv = transaction_test(pkgs, force=args.force_test,
+                                     level=args.test_level)
 
 
     # And prepare for upgrade
@@ -0,0 +1,163 @@
+# cachebudget.py - keep the download cache under a fixed size
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Least-recently-used eviction for the package and metadata cache.
+
+Normally clean_cache() just deletes every package the current upgrade
+doesn't need. With a budget, we keep as much as fits instead, so a cache
+shared by several upgrades (to different releases, say) stays useful.
+
+Each cached package is one entry, and each repo's metadata is another.
+Repos are cached per release ($cachedir/$releasever/$repoid), so the same
+repo id for two releases gives two separate metadata entries.
+Entries are evicted oldest-first (by the time they were last used, which
+we record by setting their atime) until the cache fits in the budget, but
+anything the current transaction needs is never evicted.
+'''
+
+import os, time
+from .util import rm_f, hrsize, listdir
+
+import logging
+log = logging.getLogger(__package__+".cachebudget")
+
+class CacheEntry(object):
+    '''a set of files that get used - and evicted - together'''
+    def __init__(self, kind, name, paths):
+        self.kind = kind # 'package' or 'metadata'
+        self.name = name
+        self.paths = []
+        self.size = 0
+        self.lastused = 0
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            self.paths.append(p)
+            self.size += st.st_size
+            self.lastused = max(self.lastused, st.st_atime, st.st_mtime)
+
+    def __str__(self):
+        return "%s (%s, last used %s)" % (self.name, hrsize(self.size),
+                   time.strftime("%Y-%m-%d", time.localtime(self.lastused)))
+
+def touch(paths, now=None):
+    '''mark paths as used now (without changing their mtime)'''
+    now = now or time.time()
+    for p in paths:
+        try:
+            os.utime(p, (now, os.stat(p).st_mtime))
+        except OSError as e:
+            log.debug("can't update atime for %s: %s", p, e)
+
+def _files(topdir):
+    for root, dirs, files in os.walk(topdir):
+        for f in files:
+            yield os.path.join(root, f)
+
+def scan_repo(repodir):
+    '''
+    Return the CacheEntry items for a repo cache dir: one for each package
+    (including partial downloads) and one for everything else.
+    '''
+    entries = []
+    pkgdir = os.path.join(repodir, 'packages')
+    pkgfiles = dict()
+    if os.path.isdir(pkgdir):
+        for f in os.listdir(pkgdir):
+            if '.rpm' not in f:
+                continue
+            pkg = f[:f.rindex(".rpm")+4]
+            pkgfiles.setdefault(os.path.join(pkgdir, pkg), []).append(
+                                                   os.path.join(pkgdir, f))
+    for pkg, paths in pkgfiles.items():
+        entries.append(CacheEntry('package', pkg, paths))
+    mdfiles = [f for f in _files(repodir) if not f.startswith(pkgdir+'/')]
+    if mdfiles:
+        entries.append(CacheEntry('metadata', repodir, mdfiles))
+    return entries
+
+def _isrepodir(d):
+    return os.path.isdir(d) and \
+           (os.path.exists(os.path.join(d, 'repomd.xml')) or
+            os.path.isdir(os.path.join(d, 'packages')))
+
+def old_repodirs(topdir):
+    '''repo dirs left at the top level by older versions of fedup'''
+    return [d for d in listdir(topdir) if _isrepodir(d)]
+
+def repodirs(topdir):
+    '''
+    every repo dir in the cache at topdir, whether or not it's enabled: the
+    ones in each release's dir, plus any left at the top level by older
+    versions of fedup
+    '''
+    dirs = []
+    for d in listdir(topdir):
+        if _isrepodir(d):
+            dirs.append(d)
+        elif os.path.isdir(d):
+            dirs += [r for r in listdir(d) if _isrepodir(r)]
+    return dirs
+
+def scan_cache(repodirs):
+    entries = []
+    for d in repodirs:
+        entries += scan_repo(d)
+    return entries
+
+class EvictionPlan(object):
+    '''which entries to evict to fit everything into budget bytes'''
+    def __init__(self, entries, budget, protect=(), incoming=0):
+        protect = set(protect)
+        self.budget = budget
+        self.incoming = incoming
+        self.total = sum(e.size for e in entries)
+        self.evict = []
+        used = self.total + incoming
+        for e in sorted(entries, key=lambda e: e.lastused):
+            if used <= budget:
+                break
+            if e.name in protect:
+                continue
+            self.evict.append(e)
+            used -= e.size
+        self.after = used
+        if used > budget:
+            log.warn("cache needs %s but budget is %s; everything left is "
+                     "in use", hrsize(used), hrsize(budget))
+
+    @property
+    def freed(self):
+        return sum(e.size for e in self.evict)
+
+    def report(self):
+        lines = ["cache: %s in use, %s incoming, budget %s" %
+                 (hrsize(self.total), hrsize(self.incoming),
+                  hrsize(self.budget))]
+        lines += ["evict %s %s" % (e.kind, e) for e in self.evict]
+        lines.append("%u entries (%s) to evict, leaving %s" %
+                     (len(self.evict), hrsize(self.freed), hrsize(self.after)))
+        return lines
+
+    def apply(self):
+        for e in self.evict:
+            log.debug("evicting %s %s", e.kind, e)
+            for p in e.paths:
+                rm_f(p)
@@ -101,6 +101,12 @@ class DownloadCallbackBase(ProcessTransBaseCallback):
         shortname = filename.split('/')[-1]
         self.logger.debug("verifying %u/%u %s", amount, total, shortname)
 
+    # progress for packages we download ourselves (see _download_split_pkgs)
+    def fetch(self, amount, total, filename, data):
+        if amount == total:
+            shortname = filename.split('/')[-1]
+            self.logger.debug("fetched %s (%u bytes)", shortname, total)
+
 # callback object for depsolving
 
 class DepsolveCallbackBase(object):
@@ -19,7 +19,7 @@
 
 import os, argparse, platform
 
-from . import media
+from . import media, hawkeysolve, delta
 from .sysprep import reset_boot, remove_boot, remove_cache, misc_cleanup
 from . import _
 
@@ -69,6 +69,57 @@ def parse_args(gui=False):
     yumopts.add_argument('--add-install', metavar='PKG-OR-GROUP',
         action='append', dest='add_install', default=[],
         help=_('add extra item to be installed during upgrade'))
+    yumopts.add_argument('--force-test', action='store_true', default=False,
+        help=_('run the transaction test even if nothing has changed '
+               'since the last one'))
+    yumopts.add_argument('--test-level', choices=('deps','conflicts','full'),
+        default='full',
+        help=_('how thorough the transaction test should be: dependencies '
+               'only, dependencies and file conflicts, or a full rpm test '
+               '(default: %(default)s)'))
+    yumopts.add_argument('--depsolver', choices=('yum', 'hawkey'),
+        default='yum',
+        help=_("'hawkey' uses libsolv to find updates, which is much faster "
+               "(default: %(default)s)"))
+
+
+    # === download options ===
+    dlopts = p.add_argument_group(_('download options'))
+    dlopts.add_argument('--verify-workers', metavar='N', type=int,
+        default=None,
+        help=_('number of processes for verifying cached packages '
+               '(default: one per CPU)'))
+    dlopts.add_argument('--split-size', metavar='MB', type=int, default=32,
+        help=_('with --split-count, packages larger than this get split '
+               '(default: %(default)s)'))
+    dlopts.add_argument('--split-count', metavar='N', type=int, default=1,
+        help=_('download large packages in N pieces at once, from different '
+               'mirrors (default: %(default)s, which means no splitting)'))
+    dlopts.add_argument('--download-engine', choices=('yum', 'pool'),
+        default='yum',
+        help=_("'pool' reuses connections to each mirror, which is faster "
+               "for lots of small packages (default: %(default)s)"))
+    dlopts.add_argument('--max-connections', metavar='N', type=int,
+        default=10,
+        help=_('max. simultaneous downloads for --download-engine=pool '
+               '(default: %(default)s)'))
+    dlopts.add_argument('--hedge-after', metavar='SECONDS', type=float,
+        help=_('with --download-engine=pool, if a download gets no data for '
+               'this long, also start it from the next mirror'))
+    dlopts.add_argument('--cache-budget', metavar='SIZE', type=SIZE,
+        help=_('keep up to SIZE (e.g. 20G) of old packages and metadata '
+               'in the cache, evicting the least recently used first'))
+    dlopts.add_argument('--cache-dry-run', action='store_true',
+        dest='cache_dryrun', default=False,
+        help=_('show what --cache-budget would evict, then exit'))
+    dlopts.add_argument('--skip-diskspace-check', action='store_true',
+        dest='skip_diskspace', default=False,
+        help=_("don't stop if the upgrade looks like it won't fit"))
+    dlopts.add_argument('--dedup', action='store_true', default=False,
+        help=_('keep one copy of packages that are in several repos'))
+    dlopts.add_argument('--deltarpm', action='store_true', default=False,
+        help=_('download delta RPMs where possible and rebuild the '
+               'packages from them'))
 
 
     # Magical --product option only used for upgrading to Fedora 21
@@ -107,6 +158,8 @@ def parse_args(gui=False):
         help=_('get upgrader boot images from the given URL (default: auto)'))
     net.add_argument('--instrepokey', metavar='GPGKEY', type=gpgkeyfile,
         help=_('use this GPG key to verify upgrader boot images'))
+    net.add_argument('--lazy-filelists', action='store_true', default=False,
+        help=_("don't download file lists unless a file dependency needs them"))
     p.set_defaults(repos=[])
 
     if not gui:
@@ -121,6 +174,8 @@ def parse_args(gui=False):
             help=argparse.SUPPRESS)
         p.add_argument('--clean-metadata', action='store_true', default=False,
             help=argparse.SUPPRESS)
+        p.add_argument('--cache-stats', action='store_true', default=False,
+            help=_('show how much space --dedup is saving, then exit'))
 
     args = p.parse_args()
 
@@ -128,6 +183,9 @@ def parse_args(gui=False):
         args.resetbootloader = True
         return args
 
+    if getattr(args, 'cache_stats', False):
+        return args
+
     if not (gui or args.network or args.device or args.iso or args.clean):
         p.error(_('SOURCE is required (--network, --device, --iso)'))
 
@@ -150,6 +208,15 @@ def parse_args(gui=False):
         else:
             args.add_install.append('@^%s-product-environment' % args.product)
 
+    if args.cache_dryrun and args.cache_budget is None:
+        p.error(_('--cache-dry-run requires --cache-budget'))
+
+    if args.deltarpm and not delta.available():
+        p.error(_('--deltarpm requires %s (deltarpm)') % delta.applydeltarpm)
+
+    if args.depsolver == 'hawkey' and not hawkeysolve.available():
+        p.error(_('--depsolver=hawkey requires hawkey (python-hawkey)'))
+
     # save this so we can check it later
     args.legacy_fedora = legacy_fedora
 
@@ -240,6 +307,17 @@ def VERSION(arg):
                                          % version)
     return arg
 
+def SIZE(arg):
+    '''a size like "500M" or "20G"; plain numbers are megabytes'''
+    units = {'K':1024, 'M':1024**2, 'G':1024**3, 'T':1024**4}
+    mult = units.get(arg[-1:].upper())
+    try:
+        if mult:
+            return int(float(arg[:-1]) * mult)
+        return int(float(arg) * units['M'])
+    except ValueError:
+        raise argparse.ArgumentTypeError(_("invalid size '%s'") % arg)
+
 def do_cleanup(args):
     if not args.skipbootloader:
         print "resetting bootloader config"
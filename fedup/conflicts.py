@@ -0,0 +1,220 @@
+# conflicts.py - quick file conflict check for the upgrade transaction
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Find file conflicts by comparing the file lists in package headers, which
+is much quicker than a full test transaction (no disk space accounting, no
+fingerprinting of files on disk, etc).
+
+Two packages conflict on a path (that neither has as a %ghost) if the mode
+(file type and permissions), owner, group, digest or symlink target differ
+- unless both are directories, which packages share all the time, or
+they're different colors (e.g. x86_64 and i686 multilib packages), since
+rpm sorts those out. So a directory in one package and a file or symlink
+in another is a conflict.
+
+For a whole distro's worth of packages, find_conflicts_parallel() spreads
+the work over a pool of processes: first we split the file lists of the
+headers into shards (by a hash of the path), then each worker checks a
+shard. Every copy of a path lands in the same shard, so the shards can be
+checked independently.
+
+The splitting happens in the parent, because that's where the headers and
+the rpmdb are. Our caller usually has threads running (the rpm log pipe)
+and an rpmdb open, and a forked child can't safely touch either - so the
+workers only ever get the pure-python _check step.
+
+NOTE: that means the parent still decodes every header and writes out every
+path before any worker starts, which costs more than the check itself - in
+practice the parallel version is a lot slower than plain find_conflicts(),
+so RPMUpgrade only uses it if you ask for more than one worker.
+'''
+
+import os, stat, zlib, marshal, signal
+from glob import glob
+from itertools import islice, count
+from multiprocessing import Pool, cpu_count
+from .util import TemporaryDirectory
+
+import rpm
+
+import logging
+log = logging.getLogger(__package__+".conflicts")
+
+def hdr_files(hdr):
+    '''yield (path, (mode, user, group, digest, linkto, color)) for files
+    in hdr that could conflict with something'''
+    names = hdr[rpm.RPMTAG_FILENAMES]
+    modes = hdr[rpm.RPMTAG_FILEMODES]
+    users = hdr[rpm.RPMTAG_FILEUSERNAME]
+    groups = hdr[rpm.RPMTAG_FILEGROUPNAME]
+    digests = hdr[rpm.RPMTAG_FILEDIGESTS]
+    links = hdr[rpm.RPMTAG_FILELINKTOS]
+    colors = hdr[rpm.RPMTAG_FILECOLORS]
+    flags = hdr[rpm.RPMTAG_FILEFLAGS]
+    for i, name in enumerate(names):
+        if flags[i] & rpm.RPMFILE_GHOST:
+            continue
+        mode = modes[i] & 0xffff # older rpm gives us a signed int16
+        yield name, (mode, users[i], groups[i], digests[i], links[i],
+                     colors[i])
+
+def files_conflict(a, b):
+    if stat.S_ISDIR(a[0]) and stat.S_ISDIR(b[0]):
+        return False # shared directories are fine
+    if a[5] and b[5] and a[5] != b[5]:
+        return False # multilib; rpm picks the preferred color
+    return a[:5] != b[:5]
+
+class FileConflict(object):
+    '''looks enough like an rpm.prob for summarize_problems()'''
+    def __init__(self, probtype, path, pkgNEVR, altNEVR):
+        self.type = probtype
+        self.pkgNEVR = pkgNEVR
+        self.altNEVR = altNEVR
+        self.key = None
+        self._str = path
+        self._num = 0
+
+    def __str__(self):
+        if self.type == rpm.RPMPROB_NEW_FILE_CONFLICT:
+            return "file %s conflicts between attempted installs of %s " \
+                   "and %s" % (self._str, self.pkgNEVR, self.altNEVR)
+        return "file %s from install of %s conflicts with file from " \
+               "package %s" % (self._str, self.pkgNEVR, self.altNEVR)
+
+def hdr_entries(hdrs):
+    '''yield (path, fileinfo, nevra) for every file in hdrs'''
+    for h in hdrs:
+        nevra = h[rpm.RPMTAG_NEVRA]
+        for path, info in hdr_files(h):
+            yield path, info, nevra
+
+def _check(newentries, oldentries):
+    '''
+    Return (probtype, path, pkgNEVR, altNEVR) for each conflict between the
+    new files and each other, or the new files and the old ones.
+    '''
+    owners = dict() # path -> (fileinfo, nevra)
+    conflicts = []
+    for path, info, nevra in newentries:
+        other = owners.get(path)
+        if other is None:
+            owners[path] = (info, nevra)
+        elif files_conflict(info, other[0]):
+            conflicts.append((rpm.RPMPROB_NEW_FILE_CONFLICT,
+                              path, nevra, other[1]))
+    for path, info, nevra in oldentries:
+        other = owners.get(path)
+        if other and files_conflict(other[0], info):
+            conflicts.append((rpm.RPMPROB_FILE_CONFLICT,
+                              path, other[1], nevra))
+    return conflicts
+
+def find_conflicts(newhdrs, oldhdrs):
+    '''
+    Return a list of FileConflicts between the packages being installed
+    (newhdrs), and between them and the installed packages that will still
+    be there afterward (oldhdrs).
+    '''
+    problems = [FileConflict(*c) for c in
+                _check(hdr_entries(newhdrs), hdr_entries(oldhdrs))]
+    log.debug("found %u file conflicts", len(problems))
+    return problems
+
+# --- the parallel version
+
+def shard_of(path, nshards):
+    # NOTE: not hash(), which could differ between processes
+    return (zlib.crc32(path) & 0xffffffff) % nshards
+
+# set up in each worker by _init_worker
+_tmpdir = None
+
+def _init_worker(tmpdir):
+    global _tmpdir
+    _tmpdir = tmpdir
+    # let the parent handle Ctrl-C; it'll terminate the pool for us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def installed_hdrs(instances, root='/'):
+    '''yield the headers for the given rpmdb instances'''
+    ts = rpm.TransactionSet(root)
+    try:
+        for i in instances:
+            for h in ts.dbMatch(rpm.RPMDBI_PACKAGES, i):
+                yield h
+    finally:
+        ts.closeDB()
+
+def _split(kind, hdrs, nshards, tmpdir, chunksize=500):
+    '''
+    split the files of hdrs into shard files in tmpdir, writing them out
+    every chunksize headers so we don't hold them all in memory.
+    returns the number of files.
+    '''
+    hdrs = iter(hdrs)
+    numfiles = 0
+    for chunk in count():
+        batch = list(islice(hdrs, chunksize))
+        if not batch:
+            return numfiles
+        shards = [[] for n in range(nshards)]
+        for entry in hdr_entries(batch):
+            shards[shard_of(entry[0], nshards)].append(entry)
+        numfiles += sum(len(e) for e in shards)
+        for n, entries in enumerate(shards):
+            with open(os.path.join(tmpdir, "%s.%u.%u" % (kind, n, chunk)),
+                      'wb') as outf:
+                marshal.dump(entries, outf)
+
+def _load(kind, shard):
+    for fn in glob(os.path.join(_tmpdir, "%s.%u.*" % (kind, shard))):
+        with open(fn, 'rb') as inf:
+            for entry in marshal.load(inf):
+                yield entry
+
+def _check_shard(shard):
+    '''check one shard for conflicts. runs in a worker.'''
+    return _check(_load('new', shard), _load('old', shard))
+
+def find_conflicts_parallel(newhdrs, instances, root='/', workers=None):
+    '''
+    Like find_conflicts(), but split up over a pool of worker processes.
+    The installed packages are given by their rpmdb instance numbers.
+    '''
+    if workers is None:
+        workers = cpu_count()
+    if workers <= 1:
+        return find_conflicts(newhdrs, installed_hdrs(instances, root))
+    nshards = workers * 2
+    with TemporaryDirectory(prefix='fedup-conflicts.') as tmpdir:
+        numfiles = _split('new', newhdrs, nshards, tmpdir)
+        numfiles += _split('old', installed_hdrs(instances, root),
+                           nshards, tmpdir)
+        pool = Pool(workers, _init_worker, (tmpdir,))
+        try:
+            # NOTE: get() without a timeout can't be interrupted by Ctrl-C
+            results = pool.map_async(_check_shard, range(nshards)).get(0xffff)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    problems = [FileConflict(*c) for r in results for c in r]
+    log.debug("checked %u files in %u shards, found %u file conflicts",
+              numfiles, nshards, len(problems))
+    return problems
@@ -0,0 +1,166 @@
+# delta.py - download delta RPMs and rebuild the full packages from them
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Delta RPM support.
+
+If a repo publishes prestodelta metadata, some of the new packages can be
+rebuilt from a (much smaller) .drpm plus the files of the version that's
+already installed. We download those with the DownloadEngine and, as each
+one arrives, hand it to a pool of worker processes running applydeltarpm,
+so rebuilding overlaps with the rest of the downloads.
+
+Rebuilt packages are checksummed like any other download; anything that
+fails just gets downloaded in full afterward.
+'''
+
+import os, signal
+from subprocess import Popen, PIPE, STDOUT
+from threading import Condition
+from multiprocessing import Pool, cpu_count
+from xml.etree.cElementTree import iterparse
+from yum.misc import checksum, repo_gen_decompress
+from yum.Errors import RepoError
+from .util import rm_f
+
+import logging
+log = logging.getLogger(__package__+".delta")
+
+applydeltarpm = '/usr/bin/applydeltarpm'
+# don't bother with deltas that aren't at least this much smaller
+max_ratio = 0.75
+
+def available():
+    return os.access(applydeltarpm, os.X_OK)
+
+class DeltaInfo(object):
+    '''a delta from an installed (old) version to a new package'''
+    def __init__(self, elem):
+        self.oldevr = (elem.get('oldepoch'), elem.get('oldversion'),
+                       elem.get('oldrelease'))
+        self.filename = elem.findtext('filename')
+        self.sequence = elem.findtext('sequence')
+        self.size = int(elem.findtext('size'))
+        csum = elem.find('checksum')
+        self.csum_type = csum.get('type')
+        self.csum = csum.text
+
+def parse_prestodelta(filename):
+    '''return {pkgtup: [DeltaInfo, ...]} for the given prestodelta.xml'''
+    deltas = dict()
+    for event, elem in iterparse(filename):
+        if elem.tag != 'newpackage':
+            continue
+        pkgtup = tuple(elem.get(k) for k in
+                       ('name', 'arch', 'epoch', 'version', 'release'))
+        deltas[pkgtup] = [DeltaInfo(d) for d in elem.findall('delta')]
+        elem.clear()
+    return deltas
+
+def repo_deltas(repo):
+    '''the deltas in repo's prestodelta metadata, if it has any'''
+    try:
+        if 'prestodelta' not in repo.repoXML.fileTypes():
+            return dict()
+        filename = repo.retrieveMD('prestodelta')
+        xml = repo_gen_decompress(filename, 'prestodelta.xml',
+                                  cached=repo.cache)
+        return parse_prestodelta(xml)
+    except (RepoError, IOError, OSError, SyntaxError) as e:
+        log.info("can't read deltas for %s: %s", repo.id, e)
+        return dict()
+
+def choose_delta(po, deltas, rpmdb):
+    '''the smallest delta that can rebuild po from an installed package'''
+    installed = set((str(i.epoch), i.version, i.release)
+                    for i in rpmdb.searchNevra(name=po.name, arch=po.arch))
+    usable = [d for d in deltas.get(po.pkgtup, []) if d.oldevr in installed]
+    if not usable:
+        return None
+    best = min(usable, key=lambda d: d.size)
+    if best.size > int(po.packagesize) * max_ratio:
+        return None
+    return best
+
+def _init_worker():
+    # let the parent handle Ctrl-C; it'll terminate the pool for us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _rebuild(args):
+    '''rebuild a package from a drpm. runs in a worker process.
+    returns None if it worked, or an error message if it didn't.'''
+    drpm, outpath, csum_type, csum = args
+    tmppath = outpath + '.rebuild'
+    try:
+        proc = Popen([applydeltarpm, drpm, tmppath],
+                     stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            return "applydeltarpm failed: %s" % output.strip()
+        if checksum(csum_type, tmppath) != csum:
+            return "rebuilt package has the wrong checksum"
+        os.rename(tmppath, outpath)
+        return None
+    except Exception as e:
+        # the callback has to run no matter what, or wait() will hang
+        return str(e)
+    finally:
+        rm_f(tmppath)
+        rm_f(drpm)
+
+class DeltaRebuilder(object):
+    '''
+    Rebuild packages from drpms in a pool of worker processes, starting
+    as soon as each drpm is submitted.
+    '''
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = cpu_count()
+        workers = max(1, workers)
+        log.debug("starting %u delta rebuild workers", workers)
+        self._pool = Pool(workers, _init_worker)
+        self._cond = Condition()
+        self._pending = set()
+        self.results = dict() # po -> None (OK) or error message
+
+    def submit(self, po, drpm):
+        (csum_type, csum) = po.returnIdSum()
+        with self._cond:
+            self._pending.add(po)
+        self._pool.apply_async(_rebuild,
+                               ((drpm, po.localPkg(), csum_type, csum),),
+                               callback=lambda r: self._done(po, r))
+
+    def _done(self, po, result):
+        # NOTE: this runs in the pool's result-handler thread
+        with self._cond:
+            self._pending.discard(po)
+            self.results[po] = result
+            self._cond.notify_all()
+
+    def wait(self):
+        '''wait for all the submitted rebuilds to finish'''
+        with self._cond:
+            while self._pending:
+                self._cond.wait(0xffff) # timeout so Ctrl-C still works
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
@@ -0,0 +1,238 @@
+# depcache.py - save depsolve results so identical re-runs can skip it
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Cache the transaction built by build_update_transaction().
+
+Depsolving the whole system takes minutes, and if nothing it depends on
+has changed - the installed packages, the repo metadata, the extra
+packages requested, the yum plugins - the answer won't change either.
+So we save the transaction members (and the problems yum found) along
+with a fingerprint of all those inputs, and next time, if the fingerprint
+matches, we put the same members back into tsInfo instead of solving again.
+
+Each member is saved with everything yum's depsolver would have set on it:
+its related packages (the updates/obsoletes/etc. lists as well as
+relatedto) and why it's there (reason, isDep, groups). If any of that
+can't be saved faithfully, the transaction isn't cached at all.
+'''
+
+import os, json, hashlib
+from yum.constants import TS_UPDATE, TS_INSTALL, TS_TRUEINSTALL, TS_ERASE
+from yum.constants import TS_OBSOLETING, TS_OBSOLETED, TS_UPDATED
+from .util import write_json
+from .version import version
+
+import logging
+log = logging.getLogger(__package__+".depcache")
+
+def _repomd_digest(repo):
+    with open(os.path.join(repo.cachedir, 'repomd.xml'), 'rb') as inf:
+        return hashlib.sha256(inf.read()).hexdigest()
+
+def depsolve_fingerprint(yumobj, add_install=[], depsolver='yum'):
+    '''
+    a checksum of everything that affects the result of depsolving.
+    raises IOError if some repo's repomd.xml can't be read.
+    '''
+    plugins = getattr(yumobj.plugins, '_plugins', {})
+    inputs = dict(
+        fedup=version,
+        releasever=yumobj.conf.yumvar.get('releasever'),
+        basearch=yumobj.conf.yumvar.get('basearch'),
+        rpmdb=str(yumobj.rpmdb.simpleVersion(main_only=True)[0]),
+        repos=sorted([r.id, _repomd_digest(r)]
+                     for r in yumobj.repos.listEnabled()),
+        exclude=sorted(yumobj.conf.exclude),
+        add_install=list(add_install),
+        plugins=sorted(plugins.keys()),
+        depsolver=depsolver,
+    )
+    blob = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(blob).hexdigest()
+
+# --- saving and restoring transactions
+
+# output_state -> (tsInfo method, how that method relates to the other po,
+#                  mode for DepsolveCallback.pkgAdded)
+_restore_methods = {
+    TS_UPDATE:      ('addUpdate', 'updates', 'u'),
+    TS_OBSOLETING:  ('addObsoleting', 'obsoletes', 'o'),
+    TS_INSTALL:     ('addInstall', None, 'i'),
+    TS_TRUEINSTALL: ('addTrueInstall', None, 'i'),
+    TS_ERASE:       ('addErase', None, 'e'),
+    TS_UPDATED:     ('addUpdated', 'updatedby', 'ud'),
+    TS_OBSOLETED:   ('addObsoleted', 'obsoletedby', 'od'),
+}
+# put the replaced packages back after the ones replacing them
+_restore_order = [TS_UPDATE, TS_OBSOLETING, TS_INSTALL, TS_TRUEINSTALL,
+                  TS_ERASE, TS_UPDATED, TS_OBSOLETED]
+
+# TransactionMember attributes that are lists of related packages
+_po_lists = ('updates', 'updated_by', 'obsoletes', 'obsoleted_by',
+             'downgrades', 'downgraded_by', 'depends_on')
+# ...and ones that are plain values (or lists of them)
+_plain_attrs = ('reason', 'isDep', 'groups', 'reinstall')
+
+def _pkgref(po):
+    return [po.repoid] + list(po.pkgtup)
+
+def _plain(val):
+    if isinstance(val, (list, tuple)):
+        return all(_plain(v) for v in val)
+    return val is None or isinstance(val, (basestring, bool, int, long))
+
+class Unsaveable(Exception):
+    pass
+
+def _dump_member(txmbr):
+    if txmbr.output_state not in _restore_methods:
+        raise Unsaveable("state %s" % txmbr.output_state)
+    lists = dict()
+    for attr in _po_lists:
+        pos = getattr(txmbr, attr, [])
+        if not all(hasattr(po, 'pkgtup') for po in pos):
+            raise Unsaveable("%s isn't a list of packages" % attr)
+        lists[attr] = [_pkgref(po) for po in pos]
+    attrs = dict()
+    for attr in _plain_attrs:
+        val = getattr(txmbr, attr, None)
+        if not _plain(val):
+            raise Unsaveable("can't save %s=%r" % (attr, val))
+        attrs[attr] = val
+    return dict(pkg=_pkgref(txmbr.po),
+                state=txmbr.output_state,
+                related=[_pkgref(po) + [rel] for po, rel in txmbr.relatedto],
+                lists=lists,
+                attrs=attrs)
+
+def dump_transaction(tsInfo, po_with_problems):
+    '''
+    turn the transaction into something we can write as JSON, or return None
+    if it can't be saved faithfully
+    '''
+    members = []
+    for txmbr in tsInfo.getMembers():
+        try:
+            members.append(_dump_member(txmbr))
+        except Unsaveable as e:
+            log.debug("can't save %s (%s), not caching", txmbr.po, e)
+            return None
+    problems = [[_pkgref(po1), _pkgref(po2) if po2 else None, err]
+                for po1, po2, err in po_with_problems]
+    return dict(members=members, problems=problems)
+
+class MissingPackage(Exception):
+    pass
+
+def _findpo(yumobj, ref):
+    repoid, pkgtup = ref[0], tuple(ref[1:6])
+    if repoid == 'installed':
+        found = yumobj.rpmdb.searchPkgTuple(pkgtup)
+    else:
+        found = [po for po in yumobj.pkgSack.searchPkgTuple(pkgtup)
+                 if po.repoid == repoid]
+    if not found:
+        raise MissingPackage("%s (from %s)" % (pkgtup, repoid))
+    return found[0]
+
+def restore_transaction(yumobj, data, callback=None):
+    '''
+    Put the members from dump_transaction back into yumobj.tsInfo and set
+    yumobj.po_with_problems. Returns False (with tsInfo unchanged) if any
+    of the packages can't be found.
+    '''
+    try:
+        members = []
+        for m in data['members']:
+            po = _findpo(yumobj, m['pkg'])
+            related = [(_findpo(yumobj, r[:6]), r[6]) for r in m['related']]
+            method, relation, mode = _restore_methods[m['state']]
+            args = [po]
+            if relation:
+                # the tsInfo method needs the other half of the relation
+                args += [o for o, rel in related if rel == relation][:1]
+                if len(args) < 2:
+                    raise ValueError("%s has no %s" % (po, relation))
+            lists = dict((attr, [_findpo(yumobj, r) for r in m['lists'][attr]])
+                         for attr in _po_lists)
+            attrs = dict((attr, m['attrs'][attr]) for attr in _plain_attrs)
+            members.append((m['state'], args, related, lists, attrs))
+        problems = set()
+        for ref1, ref2, err in data['problems']:
+            problems.add((_findpo(yumobj, ref1),
+                          _findpo(yumobj, ref2) if ref2 else None, err))
+    except MissingPackage as e:
+        log.info("cached transaction refers to missing package %s", e)
+        return False
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        log.info("cached transaction is damaged: %s", e)
+        return False
+
+    if callback:
+        callback.start()
+    members.sort(key=lambda m: _restore_order.index(m[0]))
+    for state, args, related, lists, attrs in members:
+        method, relation, mode = _restore_methods[state]
+        # addUpdate/addObsoleting also add the member for the package they
+        # replace, so that one might be here already
+        existing = yumobj.tsInfo.getMembersWithState(args[0].pkgtup, [state])
+        if existing:
+            txmbr = existing[0]
+        else:
+            txmbr = getattr(yumobj.tsInfo, method)(*args)
+            if callback:
+                callback.pkgAdded(args[0].pkgtup, mode)
+        if txmbr:
+            # put back everything the tsInfo method didn't set up (e.g.
+            # obsoleting several packages at once, or why it's here)
+            txmbr.relatedto = list(related)
+            for attr, pos in lists.items():
+                setattr(txmbr, attr, pos)
+            for attr, val in attrs.items():
+                setattr(txmbr, attr, val)
+    yumobj.po_with_problems = problems
+    if callback:
+        callback.end()
+    return True
+
+class DepsolveCache(object):
+    '''the most recent depsolve result, and the fingerprint it goes with'''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self, fingerprint):
+        '''return the saved transaction if it matches fingerprint'''
+        try:
+            with open(self.filename) as inf:
+                saved = json.load(inf)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            log.info("ignoring corrupt depsolve cache %s", self.filename)
+            return None
+        if saved.get('fingerprint') != fingerprint:
+            log.debug("depsolve inputs changed since last run")
+            return None
+        return saved.get('transaction')
+
+    def save(self, fingerprint, transaction):
+        try:
+            write_json(self.filename, dict(fingerprint=fingerprint,
+                                           transaction=transaction))
+        except (IOError, OSError) as e:
+            log.warn("couldn't write depsolve cache %s: %s", self.filename, e)
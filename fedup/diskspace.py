@@ -0,0 +1,156 @@
+# diskspace.py - figure out if the upgrade will fit before downloading it
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Estimate how much space (and how many inodes) the upgrade will need on
+each mounted filesystem, so we can refuse to start a download that won't
+fit instead of finding out from RPMPROB_DISKSPACE afterward.
+
+The estimates are deliberately simple: the packages still to be downloaded
+go wherever the repo's pkgdir is, linking them into packagedir is free if
+it's on the same filesystem (otherwise they get copied), each package's
+change in installed size is split between filesystems the same way as the
+files of the installed package(s) it replaces (new packages go to /usr),
+and each new kernel needs roughly as much space in /boot as the one we're
+running now.
+'''
+
+import os, platform
+from .util import df, hrsize
+from . import _
+
+import logging
+log = logging.getLogger(__package__+".diskspace")
+
+# NOTE: these are rough guesses, used when we can't measure anything better
+default_bootsize = 40*1024*1024 # a kernel + initramfs
+bytes_per_inode = 16*1024       # average size of an installed file
+slack = 0.05                    # extra space to leave free, like rpm does
+
+def mountpoint(path):
+    '''the mountpoint for the filesystem that path is (or would be) on'''
+    path = os.path.realpath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+def bootsize(bootdir='/boot'):
+    '''roughly how much space a kernel and its initramfs take in /boot'''
+    release = platform.release()
+    try:
+        return sum(os.path.getsize(os.path.join(bootdir, f % release))
+                   for f in ('vmlinuz-%s', 'initramfs-%s.img'))
+    except OSError:
+        return default_bootsize
+
+class MountSpace(object):
+    '''space needed and available on a single filesystem'''
+    def __init__(self, mnt):
+        self.mnt = mnt
+        self.needs = dict() # reason -> bytes
+        self.inodes = 0
+        self.free = df(mnt)
+        self.reserved = df(mnt, reserved=True) - self.free
+        s = os.statvfs(mnt)
+        # some filesystems (btrfs, for instance) don't have a fixed number
+        # of inodes, and say they have zero
+        self.inodes_free = s.f_favail if s.f_files else None
+
+    @property
+    def need(self):
+        return sum(self.needs.values())
+
+    @property
+    def short(self):
+        '''bytes we'd need to free up to make this fit'''
+        return max(0, int(self.need * (1+slack)) - self.free)
+
+    @property
+    def inodes_short(self):
+        if self.inodes_free is None:
+            return 0
+        return max(0, self.inodes - self.inodes_free)
+
+    def __str__(self):
+        detail = ", ".join("%s %s" % (why, hrsize(size))
+                           for why, size in sorted(self.needs.items()) if size)
+        msg = _("%s needs %s (%s); %s free") % (self.mnt, hrsize(self.need),
+                                                detail, hrsize(self.free))
+        if self.reserved:
+            msg += _(" (+%s reserved)") % hrsize(self.reserved)
+        if self.inodes_free is not None:
+            msg += _(", %u of %u inodes") % (self.inodes, self.inodes_free)
+        return msg
+
+class SpacePlan(object):
+    '''
+    The space the upgrade will need on each filesystem.
+
+    Add things with add(path, why, size, inodes); the filesystem for path is
+    found automatically. Then check problems() before starting.
+    '''
+    def __init__(self):
+        self.mounts = dict() # st_dev -> MountSpace
+        self._dirs = dict()  # dirname -> MountSpace
+
+    def _mount(self, path):
+        mnt = mountpoint(path)
+        dev = os.stat(mnt).st_dev
+        if dev not in self.mounts:
+            self.mounts[dev] = MountSpace(mnt)
+        return self.mounts[dev]
+
+    def _dirmount(self, dirname):
+        # every package has files in the same few hundred dirs, so don't
+        # go looking for the mountpoint of each one every time
+        if dirname not in self._dirs:
+            self._dirs[dirname] = self._mount(dirname)
+        return self._dirs[dirname]
+
+    def filesizes(self, hdr):
+        '''sizes of the files in the rpm header hdr, as {mountpoint:bytes}'''
+        sizes = dict()
+        dirnames = hdr['dirnames']
+        for idx, size in zip(hdr['dirindexes'], hdr['filesizes']):
+            mnt = self._dirmount(dirnames[idx]).mnt
+            sizes[mnt] = sizes.get(mnt, 0) + size
+        return sizes
+
+    def samefs(self, path1, path2):
+        return self._mount(path1) is self._mount(path2)
+
+    def add(self, path, why, size, inodes=0):
+        m = self._mount(path)
+        m.needs[why] = m.needs.get(why, 0) + size
+        m.inodes += inodes
+
+    def report(self):
+        return [str(m) for m in sorted(self.mounts.values(),
+                                       key=lambda m: m.mnt) if m.need]
+
+    def problems(self):
+        probs = []
+        for m in sorted(self.mounts.values(), key=lambda m: m.mnt):
+            if m.short:
+                probs.append(_("%s needs %s more free space") %
+                             (m.mnt, hrsize(m.short)))
+            if m.inodes_short:
+                probs.append(_("%s needs %u more free inodes") %
+                             (m.mnt, m.inodes_short))
+        return probs
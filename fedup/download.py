@@ -27,7 +27,7 @@ from .treeinfo import Treeinfo, TreeinfoError
 from .conf import Config
 from yum.Errors import YumBaseError, InstallError
 from yum.parser import varReplace
-from yum.constants import TS_REMOVE_STATES, TS_TRUEINSTALL
+from yum.constants import TS_REMOVE_STATES, TS_TRUEINSTALL, TS_INSTALL
 from yum.misc import gpgme
 
 enabled_plugins = ['blacklist', 'whiteout']
@@ -36,8 +36,24 @@ disabled_plugins = ['rpm-warm-cache', 'remove-with-leaves', 'presto',
 
 from . import _
 from . import cachedir, upgradeconf, kernelpath, initrdpath, defaultkey
+from . import packagedir
 from . import mirrormanager
-from .util import listdir, mkdir_p, rm_rf, isxen
+from .util import listdir, rlistdir, mkdir_p, rm_rf, isxen, hrsize
+from .verify import verify_local_pkgs, VerifyCache, SigCheckPool
+from .verify import mark_verified
+from .grab import grab_and_hash
+from .engine import DownloadEngine, Job, pkg_job, md_job, can_fetch
+from .engine import engine_urls
+from .mirrors import MirrorStats, hostof
+from .mdquery import RepoQuery, NoPrimaryDB
+from .depcache import DepsolveCache, depsolve_fingerprint
+from .depcache import dump_transaction, restore_transaction
+from .hawkeysolve import hawkey_update_transaction, SolverError
+from .diskspace import SpacePlan, bootsize, bytes_per_inode
+from .cachebudget import EvictionPlan, scan_cache, repodirs, touch
+from .cachebudget import old_repodirs
+from .objstore import ObjectStore
+from .delta import DeltaRebuilder, repo_deltas, choose_delta
 from shutil import copy2
 
 log = logging.getLogger(__package__+".yum") # maybe I should rename this..
@@ -78,6 +94,36 @@ def import_key(keydata, hexkeyid, gpgdir):
     yum.misc.import_key_to_pubring(keydata, hexkeyid,
                                    gpgdir=gpgdir, make_ro_copy=False)
 
+class TransactionIndex(object):
+    '''
+    Lookup tables for a finished transaction, so the reports we make after
+    depsolving don't have to search tsInfo once for every package.
+    '''
+    def __init__(self, tsInfo):
+        self.tsInfo = tsInfo
+        self.installs = dict()    # name -> [txmbr, ...] for TS_TRUEINSTALL
+        self.removed = set()      # pkgtups being removed/updated/obsoleted
+        self.replacements = dict() # pkgtup -> (oldpo, newpo)
+        for txmbr in tsInfo.getMembers():
+            if txmbr.output_state in TS_REMOVE_STATES:
+                self.removed.add(txmbr.pkgtup)
+            elif txmbr.output_state == TS_TRUEINSTALL:
+                self.installs.setdefault(txmbr.name, []).append(txmbr)
+            if txmbr.pkgtup in self.replacements:
+                continue
+            # XXX multiple replacers?
+            for otherpo, rel in txmbr.relatedto:
+                if rel in ('obsoletedby', 'updatedby'):
+                    self.replacements[txmbr.pkgtup] = (txmbr.po, otherpo)
+                    break
+                if rel in ('obsoletes', 'updates'):
+                    self.replacements[txmbr.pkgtup] = (otherpo, txmbr.po)
+                    break
+
+    def replacement(self, po):
+        '''(oldpkg, newpkg) for po, or None if nothing replaces it'''
+        return self.replacements.get(po.pkgtup)
+
 def list_keyring(gpgdir):
     return [yum.misc.keyIdToRPMVer(int(k, 16))
             for k in yum.misc.return_keyids_from_pubring(gpgdir)]
@@ -98,13 +144,39 @@ class UpgradeDownloader(yum.YumBase):
         if version:
             self.preconf.releasever = version
         self.cacheonly = cacheonly
-        self.prerepoconf.cachedir = cachedir
+        # each release's repos get their own cache dirs, so a cache shared
+        # by upgrades to several releases can hold all of their metadata
+        self.repocachedir = os.path.join(cachedir, version) if version \
+                            else cachedir
+        self.prerepoconf.cachedir = self.repocachedir
         self.prerepoconf.cache = cacheonly
         log.debug("prerepoconf.cache=%i", self.prerepoconf.cache)
         self.instrepoid = None
         self.disabled_repos = []
         self._treeinfo = None
         self._lastinterrupt = 0
+        self.verify_workers = None # None means "one per CPU"
+        self.split_size = 32*1024*1024 # packages this big get split up..
+        self.split_count = 1           # ..into this many pieces (1: don't)
+        self.download_engine = 'yum'
+        self.max_connections = 10
+        self.hedge_after = None # seconds without progress; None means never
+        self.depsolver = 'yum' # or 'hawkey'
+        self._multi_progress = None
+        self._txindex = None
+        self._rebuilding = set() # being rebuilt from deltas; see downloadPkgs
+        self.verifycache = VerifyCache(os.path.join(cachedir, 'verify.cache'))
+        self.depcache = DepsolveCache(os.path.join(cachedir, 'depsolve.cache'))
+        self.mirrorstats = MirrorStats(os.path.join(cachedir, 'mirrors.cache'))
+        self.objstore = ObjectStore(os.path.join(cachedir, 'objects'))
+        self.dedup = False # share identical packages via objstore
+        self.deltarpm = False # rebuild packages from drpms where possible
+        self.delta_saved = 0 # bytes we didn't download thanks to drpms
+        # don't fetch filelists until doSackFilelistPopulate() needs them
+        self.lazy_filelists = False
+        self._filelists_loaded = False
+        self._grab_failures = []
+        self._sigcheck = None
         # TODO: locking to prevent multiple instances
         self.verbose_logger = log
 
@@ -116,6 +188,8 @@ class UpgradeDownloader(yum.YumBase):
             conf.disable_excludes = ['all']
             conf.cache = self.cacheonly
             conf.deltarpm = 0
+            if self.lazy_filelists:
+                conf.mdpolicy = ['group:primary']
             log.debug("conf.cache=%i", conf.cache)
         return conf
 
@@ -132,15 +206,38 @@ class UpgradeDownloader(yum.YumBase):
         r = yum.yumRepo.YumRepository(repoid)
         r.name = repoid
         r.base_persistdir = cachedir
-        r.basecachedir = cachedir
+        r.basecachedir = self.repocachedir
         r.cache = self.cacheonly
         r.failovermethod = 'priority'
+        r.mdpolicy = self.conf.mdpolicy
         r.baseurl = [varReplace(u, self.conf.yumvar) for u in baseurls if u]
         if mirrorlist:
             r.mirrorlist = varReplace(mirrorlist, self.conf.yumvar)
         self._repos.add(r)
         self._repos.enableRepo(repoid)
 
+    def _migrate_repo_cache(self, repo):
+        '''
+        move repo's cache from where older versions of fedup kept it
+        ($cachedir/$repoid) to this release's dir, so we don't have to
+        download it all again.
+        NOTE: yum creates the (empty) dirs for repo.cachedir the first time
+        anything looks at it, so an empty new dir gets replaced.
+        '''
+        if self.repocachedir == cachedir:
+            return
+        old = os.path.join(cachedir, repo.id)
+        new = os.path.join(self.repocachedir, repo.id)
+        if not os.path.isdir(old) or any(rlistdir(new)):
+            return
+        log.info("moving cache for %s to %s", repo.id, new)
+        try:
+            mkdir_p(self.repocachedir)
+            rm_rf(new)
+            os.rename(old, new)
+        except OSError as e:
+            log.info("couldn't move %s: %s", old, e)
+
     def interrupt_callback(self, cbobj):
         '''Basically the same as YumOutput.interrupt_callback()'''
         exit_time = 2
@@ -156,16 +253,115 @@ class UpgradeDownloader(yum.YumBase):
             self._lastinterrupt = now
             raise yum.URLGrabError(15, "user interrupt") # skip to next mirror
 
+    def grab_failure(self, failobj):
+        '''log_grab_failure, but also remember which mirror failed'''
+        self._grab_failures.append(failobj.url)
+        self.mirrorstats.record_failure(failobj.url)
+        log_grab_failure(failobj)
+
+    def _rank_mirrors(self, repo):
+        '''sort repo's mirrors by how well they've done for us before'''
+        urls = repo.urls # NOTE: this fetches the mirrorlist, if needed
+        ranked = self.mirrorstats.rank(urls)
+        if ranked != urls:
+            log.debug("mirror order for %s: %s", repo.id,
+                      " ".join(hostof(u) for u in ranked))
+            repo.urls = ranked
+            repo._grab = None # make yum set up its MirrorGroup again
+
+    def _record_repomd(self, repo, start):
+        '''if repo's repomd.xml was just downloaded, record how long it took'''
+        try:
+            st = os.stat(os.path.join(repo.cachedir, 'repomd.xml'))
+        except (AttributeError, OSError):
+            return
+        if st.st_ctime < start:
+            return # didn't fetch it; it was already in the cache
+        failed = set(hostof(u) for u in self._grab_failures)
+        for url in repo.urls:
+            if hostof(url) not in failed:
+                self.mirrorstats.record(url, latency=time.time()-start, ok=1)
+                break
+
+    @property
+    def prefetch_mdtypes(self):
+        '''metadata to fetch for each repo in setup_repos'''
+        if self.lazy_filelists:
+            return ['primary']
+        return ['primary', 'filelists']
+
+    def _md_wanted(self, repo):
+        '''the metadata types the sack will need (sqlite DBs if available)'''
+        md_types = repo.repoXML.fileTypes()
+        for mdtype in self.prefetch_mdtypes:
+            if mdtype+'_db' in md_types:
+                yield mdtype+'_db'
+            elif mdtype in md_types:
+                yield mdtype
+
+    def _prefetch_md(self, repos):
+        '''
+        Fetch the metadata the sack will need for all of repos at once.
+        The DownloadEngine gets the files for the repos it can handle (see
+        can_fetch) in parallel; then yum's retrieveMD() checks those, and
+        fetches the rest, one at a time.
+        NOTE: yum's repo objects (and urlgrabber's curl handle) aren't
+        thread-safe, so the engine just writes the files into the cachedir
+        and never touches the repo objects.
+        '''
+        jobs = []
+        if not self.cacheonly:
+            for repo in repos:
+                if not can_fetch(repo):
+                    continue
+                for mdtype in self._md_wanted(repo):
+                    job = md_job(repo, mdtype)
+                    if job.urls and not os.path.exists(job.outpath):
+                        jobs.append(job)
+        if jobs:
+            log.info("fetching %u metadata files with up to %u connections",
+                     len(jobs), self.max_connections)
+            engine = DownloadEngine(maxconn=self.max_connections,
+                                    multi_progress=self._multi_progress)
+            for job in engine.fetch_all(jobs):
+                if not job.done:
+                    log.info("couldn't prefetch %s, will retry", job.relpath)
+        for repo in repos:
+            for mdtype in self._md_wanted(repo):
+                try:
+                    repo.retrieveMD(mdtype)
+                except yum.Errors.RepoError as e:
+                    # we'll try again (and fail properly) when loading the sack
+                    log.info("couldn't fetch %s for %s: %s",
+                             mdtype, repo.id, e)
+
+    def _setup_repo(self, repo):
+        '''
+        Fetch repomd.xml for repo.
+        Returns False if the repo doesn't seem to be usable.
+        '''
+        self._grab_failures = []
+        start = time.time()
+        try:
+            self._rank_mirrors(repo)
+            repo.repoXML.fileTypes()
+        except yum.Errors.RepoError:
+            log.info("can't find valid repo metadata for %s", repo.id)
+            return False
+        self._record_repomd(repo, start)
+        log.debug("setup for repo %s took %.2fs", repo.id, time.time()-start)
+        return True
+
     def setup_repos(self, callback=None, progressbar=None, multi_progressbar=None, repos=[]):
         '''Return a list of repos that had problems setting up.'''
         # These will set up progressbar and callback when we actually do setup
         self.prerepoconf.progressbar = progressbar
         self.prerepoconf.multi_progressbar = multi_progressbar
+        self._multi_progress = multi_progressbar
         self.prerepoconf.callback = callback
-        self.prerepoconf.failure_callback = log_grab_failure
+        self.prerepoconf.failure_callback = self.grab_failure
         self.prerepoconf.interrupt_callback = self.interrupt_callback
 
-        # TODO invalidate cache if the version doesn't match previous version
         log.info("checking repos")
 
         # Add default instrepo (and its key) if needed
@@ -201,6 +397,9 @@ class UpgradeDownloader(yum.YumBase):
                     repo.proxy_username = self.conf.proxy_username
                     repo.proxy_password = self.conf.proxy_password
 
+        for repo in self.repos.listEnabled():
+            self._migrate_repo_cache(repo)
+
         # add GPG keys *after* the repos are created
         for action, repo in repos:
             if action == 'gpgkey':
@@ -212,15 +411,17 @@ class UpgradeDownloader(yum.YumBase):
         # set up callbacks for any newly-added repos
         self.repos.setProgressBar(progressbar, multi_progressbar)
         self.repos.callback = callback
-        self.repos.setFailureCallback(log_grab_failure)
+        self.repos.setFailureCallback(self.grab_failure)
         self.repos.setInterruptCallback(self.interrupt_callback)
 
-        # check enabled repos
-        for repo in self.repos.listEnabled():
-            try:
-                md_types = repo.repoXML.fileTypes()
-            except yum.Errors.RepoError:
-                log.info("can't find valid repo metadata for %s", repo.id)
+        # check enabled repos, then fetch their metadata all at once
+        enabled = self.repos.listEnabled()
+        ok = [self._setup_repo(repo) for repo in enabled]
+        self._prefetch_md([repo for repo, repo_ok in zip(enabled, ok)
+                           if repo_ok])
+
+        for repo, repo_ok in zip(enabled, ok):
+            if not repo_ok:
                 repo.disable()
                 self.disabled_repos.append(repo.id)
             else:
@@ -234,6 +435,7 @@ class UpgradeDownloader(yum.YumBase):
                 repo._override_sigchecks = True
 
         log.debug("repos.cache=%i", self.repos.cache)
+        self.mirrorstats.save()
 
         return self.disabled_repos
 
@@ -249,8 +451,101 @@ class UpgradeDownloader(yum.YumBase):
             except IOError as e:
                 log.warn("couldn't write repofile for %s: %s", repo.id, str(e))
 
+    def repos_empty(self):
+        '''True if the enabled repos don't have any packages at all'''
+        query = RepoQuery(self.repos.listEnabled())
+        try:
+            return query.empty()
+        except NoPrimaryDB as e:
+            log.debug("can't query primary_db (%s), checking pkgSack", e)
+            return len(self.pkgSack) == 0
+        finally:
+            query.close()
+
+    def repos_whatprovides(self, name):
+        '''
+        Find packages in the enabled repos that provide name.
+        Returns (repoid, pkgtup) tuples, or package objects if we had to
+        ask pkgSack.
+        '''
+        query = RepoQuery(self.repos.listEnabled())
+        try:
+            return query.whatprovides(name)
+        except NoPrimaryDB as e:
+            log.debug("can't query primary_db (%s), checking pkgSack", e)
+            return self.pkgSack.searchProvides(name)
+        finally:
+            query.close()
+
+    def doSackFilelistPopulate(self):
+        '''yum calls this when primary can't resolve a file dependency'''
+        if not self.lazy_filelists or self._filelists_loaded:
+            return yum.YumBase.doSackFilelistPopulate(self)
+        log.debug("lazy filelists: needed for a file dependency, fetching")
+        start = time.time()
+        yum.YumBase.doSackFilelistPopulate(self)
+        self._filelists_loaded = True
+        log.debug("lazy filelists: loaded in %.2fs", time.time()-start)
+
+    def _cached_transaction(self, fingerprint, callback=None):
+        '''load the transaction from a previous identical run, if possible'''
+        saved = self.depcache.load(fingerprint)
+        if saved is None:
+            return False
+        log.info("reusing transaction from previous run")
+        return restore_transaction(self, saved, callback)
+
+    def _updating_pkgs(self):
+        return [t.po for t in self.tsInfo.getMembers()
+                     if t.po and t.ts_state in ("i", "u")]
+
+    @property
+    def txindex(self):
+        '''a TransactionIndex for the current tsInfo'''
+        if self._txindex is None or self._txindex.tsInfo is not self.tsInfo:
+            self._txindex = TransactionIndex(self.tsInfo)
+        return self._txindex
+
     # NOTE: could raise RepoError if metadata is missing/busted
     def build_update_transaction(self, callback=None, add_install=[]):
+        try:
+            fingerprint = depsolve_fingerprint(self, add_install,
+                                               self.depsolver)
+        except (IOError, OSError) as e:
+            log.info("can't fingerprint depsolve inputs (%s), not caching", e)
+            fingerprint = None
+        self._txindex = None
+        if fingerprint and self._cached_transaction(fingerprint, callback):
+            return self._updating_pkgs()
+
+        if not (self.depsolver == 'hawkey' and
+                self._hawkey_depsolve(callback, add_install)):
+            self._yum_depsolve(callback, add_install)
+        if self.lazy_filelists:
+            log.debug("lazy filelists: %s", "fetched on demand"
+                      if self._filelists_loaded else "never needed")
+        if fingerprint:
+            saved = dump_transaction(self.tsInfo, self.po_with_problems)
+            if saved is not None:
+                self.depcache.save(fingerprint, saved)
+        return self._updating_pkgs()
+
+    def _hawkey_depsolve(self, callback, add_install):
+        '''try depsolving with libsolv. returns False if that didn't work.'''
+        start = time.time()
+        try:
+            hawkey_update_transaction(self, os.path.join(cachedir, 'hawkey'),
+                                      add_install, callback,
+                                      lazy_filelists=self.lazy_filelists)
+        except SolverError as e:
+            log.warn("libsolv depsolve failed: %s", e)
+            log.warn("falling back to yum depsolver")
+            del self.tsInfo # throw away anything that got added
+            return False
+        log.info("libsolv depsolve took %.2fs", time.time()-start)
+        return True
+
+    def _yum_depsolve(self, callback, add_install):
         log.info("looking for updates")
         self.dsCallback = callback
         # get updates for everything on the system
@@ -276,28 +571,22 @@ class UpgradeDownloader(yum.YumBase):
             log.info("    %s", m)
         # NOTE: we ignore errors, as anaconda did before us.
         self.dsCallback = None
-        return [t.po for t in self.tsInfo.getMembers()
-                     if t.po and t.ts_state in ("i", "u")]
 
     def find_packages_without_updates(self):
         '''packages on the local system that aren't being updated/obsoleted'''
-        remove = self.tsInfo.getMembersWithState(output_states=TS_REMOVE_STATES)
-        inst = self.tsInfo.getMembersWithState(output_states=[TS_TRUEINSTALL])
-        instnames = [p.name for p in inst]
+        idx = self.txindex
         return set(p for p in self.rpmdb \
-                     if p not in remove and p.name not in instnames)
+                     if p.pkgtup not in idx.removed
+                        and p.name not in idx.installs)
 
     def describe_transaction_problems(self):
         problems = []
+        idx = self.txindex
 
         def find_replacement(po):
-            for tx in self.tsInfo.getMembers(po.pkgtup):
-                # XXX multiple replacers?
-                for otherpo, rel in tx.relatedto:
-                    if rel in ('obsoletedby', 'updatedby'):
-                        return po, otherpo
-                    if rel in ('obsoletes', 'updates'):
-                        return otherpo, po
+            found = idx.replacement(po)
+            if found:
+                return found
             if po in self.rpmdb:
                 return po, None
             else:
@@ -327,21 +616,72 @@ class UpgradeDownloader(yum.YumBase):
         return problems
 
     def download_packages(self, pkgs, callback=None):
+        # Start the signature checkers now, so packages can be checked as
+        # soon as they've been verified (see verifyPkg) instead of all at
+        # once after the download finishes.
+        if any(self._need_sigcheck(p) for p in pkgs):
+            self._sigcheck = SigCheckPool(root=self.conf.installroot,
+                                          workers=self.verify_workers)
+        try:
+            self._download_packages(pkgs, callback)
+        finally:
+            if self._sigcheck:
+                self._sigcheck.close()
+                self._sigcheck = None
+
+    def _download_packages(self, pkgs, callback):
         # Verifying a full upgrade payload of ~2000 pkgs takes a good 90-120
         # seconds with no callback. Unacceptable!
-        # So: here we have our own verifyPkg loop, with callback.
+        # So: here we have our own verify loop, with callback, which spreads
+        # the checksumming over a pool of worker processes.
         # The results get cached, so when yum does it again in the real
         # _downloadPackages function it's a negligible delay.
+        if self.dedup:
+            self._link_from_store(pkgs)
         localpkgs = [p for p in pkgs if os.path.exists(p.localPkg())]
         total = len(localpkgs)
-        # XXX: multithreading?
-        for num, p in enumerate(localpkgs, 1):
-            local = p.localPkg()
+        verified = verify_local_pkgs(localpkgs, workers=self.verify_workers,
+                                     cache=self.verifycache)
+        okpkgs = set()
+        for num, (p, ok) in enumerate(verified, 1):
             if hasattr(callback, "verify") and callable(callback.verify):
-                callback.verify(num, total, local, None)
-            ok = self.verifyPkg(local, p, False) # result will be cached by yum
-        log.info("beginning package download...")
-        updates = self._downloadPackages(callback)
+                callback.verify(num, total, p.localPkg(), None)
+            if ok:
+                okpkgs.add(p)
+                if self._sigcheck and self._need_sigcheck(p):
+                    self._sigcheck.submit(p)
+        # save it now, in case the download gets interrupted
+        self.verifycache.save()
+        rebuilder = None
+        try:
+            # fetch drpms; the rebuilds keep going while we download the rest
+            if self.deltarpm:
+                rebuilder, deltapkgs = self._download_delta_pkgs(
+                                    [p for p in pkgs if p not in okpkgs])
+                okpkgs.update(deltapkgs)
+                self._rebuilding = set(deltapkgs)
+            # grab the big ones in pieces from multiple mirrors
+            self._download_split_pkgs([p for p in pkgs if p not in okpkgs],
+                                      callback)
+            if self.download_engine == 'pool':
+                self._download_pool_pkgs([p for p in pkgs if p not in okpkgs])
+            log.info("beginning package download...")
+            try:
+                updates = self._downloadPackages(callback)
+                if rebuilder:
+                    # anything that couldn't be rebuilt gets fetched in full
+                    self._rebuilding = set()
+                    if self._finish_delta_pkgs(rebuilder, deltapkgs):
+                        self._downloadPackages(callback)
+            finally:
+                self._save_verified(pkgs)
+                self.mirrorstats.save()
+                if self.dedup:
+                    self._add_to_store(pkgs)
+        finally:
+            self._rebuilding = set()
+            if rebuilder:
+                rebuilder.close()
 
         # Handle _downloadPackages returning None instead of an empty list
         if updates is None:
@@ -357,17 +697,302 @@ class UpgradeDownloader(yum.YumBase):
         if updates:
             self._checkSignatures(updates, callback)
 
+    def _link_from_store(self, pkgs):
+        '''link packages we don't have yet in from the object store'''
+        found = 0
+        for p in pkgs:
+            if p.repo.mediaid or os.path.exists(p.localPkg()):
+                continue
+            (csum_type, csum) = p.returnIdSum()
+            obj = self.objstore.link_into(csum_type, csum, p.localPkg())
+            if obj is None:
+                continue
+            found += 1
+            # it's the same file, so it's verified if the object is
+            st = self.verifycache.lookup(obj, csum_type, csum)
+            if st:
+                self.verifycache.add(p.localPkg(), csum_type, csum, st)
+        if found:
+            log.info("found %u packages in object store", found)
+
+    def _add_to_store(self, pkgs):
+        '''put the (verified) packages into the object store'''
+        for p in pkgs:
+            if p.repo.mediaid:
+                continue
+            (csum_type, csum) = p.returnIdSum()
+            st = self.verifycache.lookup(p.localPkg(), csum_type, csum)
+            if not st:
+                continue
+            obj = self.objstore.add(p.localPkg(), csum_type, csum)
+            if obj:
+                self.verifycache.add(obj, csum_type, csum, os.stat(obj))
+        self.verifycache.save()
+
+    def _download_delta_pkgs(self, pkgs):
+        '''
+        Fetch drpms for any packages that have usable deltas, and start
+        rebuilding each one as soon as it arrives. Returns the rebuilder
+        and a dict of {po: delta} for the packages it's working on.
+        '''
+        deltas = dict()
+        repodeltas = dict()
+        for p in pkgs:
+            if not can_fetch(p.repo):
+                continue
+            if p.repo.id not in repodeltas:
+                repodeltas[p.repo.id] = repo_deltas(p.repo)
+            d = choose_delta(p, repodeltas[p.repo.id], self.rpmdb)
+            if d:
+                deltas[p] = d
+        if not deltas:
+            return None, dict()
+        log.info("downloading deltas for %u packages (%s instead of %s)",
+                 len(deltas), hrsize(sum(d.size for d in deltas.values())),
+                 hrsize(sum(int(p.packagesize) for p in deltas)))
+        jobs = []
+        for p, d in deltas.items():
+            drpmdir = os.path.join(p.repo.cachedir, 'drpms')
+            mkdir_p(drpmdir)
+            jobs.append(Job(engine_urls(p.repo), d.filename,
+                            os.path.join(drpmdir, os.path.basename(d.filename)),
+                            d.csum_type, d.csum, size=d.size, data=p))
+        rebuilder = DeltaRebuilder(workers=self.verify_workers)
+        def fetched(job):
+            if job.done:
+                rebuilder.submit(job.data, job.outpath)
+        engine = DownloadEngine(maxconn=self.max_connections,
+                                multi_progress=self._multi_progress,
+                                hedge_after=self.hedge_after)
+        try:
+            engine.fetch_all(jobs, callback=fetched)
+        except:
+            rebuilder.close()
+            raise
+        return rebuilder, dict((j.data, deltas[j.data]) for j in jobs
+                               if j.done)
+
+    def _finish_delta_pkgs(self, rebuilder, deltapkgs):
+        '''
+        wait for the rebuilds, and return the packages that couldn't be
+        rebuilt (which need to be fetched in full)
+        '''
+        rebuilder.wait()
+        failed = []
+        for p, d in deltapkgs.items():
+            err = rebuilder.results.get(p)
+            if err:
+                log.info("couldn't rebuild %s from delta (%s), will download",
+                         p, err)
+                failed.append(p)
+                continue
+            mark_verified(p)
+            (csum_type, csum) = p.returnIdSum()
+            self.verifycache.add(p.localPkg(), csum_type, csum)
+            if self._sigcheck and self._need_sigcheck(p):
+                self._sigcheck.submit(p)
+            self.delta_saved += int(p.packagesize) - d.size
+        self.verifycache.save()
+        log.info("rebuilt %u packages from deltas, saving %s",
+                 len([e for e in rebuilder.results.values() if e is None]),
+                 hrsize(self.delta_saved))
+        return failed
+
+    def downloadPkgs(self, pkglist, *args, **kwargs):
+        '''
+        yum's downloadPkgs, but skipping packages that are being rebuilt from
+        deltas while the rest download (see _download_packages)
+        '''
+        if self._rebuilding:
+            pkglist = [p for p in pkglist if p not in self._rebuilding]
+        return yum.YumBase.downloadPkgs(self, pkglist, *args, **kwargs)
+
+    def _want_split(self, po):
+        if self.split_count < 2 or not can_fetch(po.repo):
+            return False
+        if int(po.packagesize) < self.split_size:
+            return False
+        return len(engine_urls(po.repo)) > 1
+
+    def _download_split_pkgs(self, pkgs, callback=None):
+        '''
+        Fetch large packages in split_count pieces at once, from different
+        mirrors. Anything that fails here is left for _downloadPackages.
+        '''
+        splitpkgs = [p for p in pkgs if self._want_split(p)]
+        if not splitpkgs:
+            return
+        log.info("downloading %u large packages in %u pieces",
+                 len(splitpkgs), self.split_count)
+        engine = DownloadEngine(maxconn=self.max_connections)
+        for p in splitpkgs:
+            progress = None
+            if hasattr(callback, "fetch") and callable(callback.fetch):
+                filename = p.localPkg()
+                progress = lambda amount, total: \
+                                callback.fetch(amount, total, filename, None)
+            if not engine.fetch_segmented(pkg_job(p), self.split_count,
+                                          progress):
+                log.info("couldn't fetch %s in pieces, will retry", p)
+                continue
+            mark_verified(p)
+            (csum_type, csum) = p.returnIdSum()
+            self.verifycache.add(p.localPkg(), csum_type, csum)
+            if self._sigcheck and self._need_sigcheck(p):
+                self._sigcheck.submit(p)
+        engine.close()
+        self.verifycache.save()
+
+    def _download_pool_pkgs(self, pkgs):
+        '''
+        Fetch packages with our own DownloadEngine, which reuses connections
+        to each mirror. Anything that fails (or that the engine can't handle,
+        like proxies and non-HTTP repos; see can_fetch) is left for
+        _downloadPackages.
+        '''
+        pkgs = [p for p in pkgs if can_fetch(p.repo)
+                and not (os.path.exists(p.localPkg()) and p.verifyLocalPkg())]
+        if not pkgs:
+            return
+        log.info("downloading %u packages with up to %u connections",
+                 len(pkgs), self.max_connections)
+        engine = DownloadEngine(maxconn=self.max_connections,
+                                multi_progress=self._multi_progress,
+                                hedge_after=self.hedge_after)
+        for job in engine.fetch_all(pkg_job(p) for p in pkgs):
+            p = job.data
+            if not job.done:
+                log.info("couldn't fetch %s, will retry", p)
+                continue
+            mark_verified(p)
+            (csum_type, csum) = p.returnIdSum()
+            self.verifycache.add(p.localPkg(), csum_type, csum)
+            if self._sigcheck and self._need_sigcheck(p):
+                self._sigcheck.submit(p)
+        self.verifycache.save()
+        for host in engine.hosts():
+            self.mirrorstats.record(host.url, rate=host.avgrate,
+                                    ok=host.requests - host.errors,
+                                    failed=host.errors)
+
+    def _save_verified(self, pkgs):
+        '''add packages yum verified during download to our verify cache'''
+        for p in pkgs:
+            st = getattr(p, '_verify_local_pkg_cache', None)
+            if st:
+                (csum_type, csum) = p.returnIdSum()
+                self.verifycache.add(p.localPkg(), csum_type, csum, st)
+        self.verifycache.save()
+
+    def plan_diskspace(self, pkgs):
+        '''work out how much space the upgrade of pkgs needs; see diskspace'''
+        plan = SpacePlan()
+        for pkg in pkgs:
+            if pkg.remote_url.startswith("file://"):
+                continue # nothing to download or link
+            local = pkg.localPkg()
+            if os.path.exists(local) and os.path.getsize(local) == pkg.size:
+                todo = 0
+            elif os.path.exists(local+'.part'):
+                todo = max(0, pkg.size - os.path.getsize(local+'.part'))
+            else:
+                todo = pkg.size
+            plan.add(local, _("download"), todo, inodes=1 if todo else 0)
+            if not plan.samefs(local, packagedir):
+                plan.add(packagedir, _("copy"), pkg.size, inodes=1)
+        # the new packages get installed and the old ones removed..
+        delta = dict() # mountpoint -> bytes
+        oldsizes = dict() # pkgtup -> {mountpoint:bytes}
+        def sizes(po):
+            if po.pkgtup not in oldsizes:
+                hdr = getattr(po, 'hdr', None)
+                oldsizes[po.pkgtup] = plan.filesizes(hdr) if hdr else {}
+            return oldsizes[po.pkgtup]
+        for t in self.tsInfo.getMembers():
+            if t.output_state in TS_REMOVE_STATES:
+                for mnt, size in sizes(t.po).items():
+                    delta[mnt] = delta.get(mnt, 0) - size
+                continue
+            # split the new package up like the one(s) it replaces
+            split = dict()
+            for oldpo, rel in t.relatedto:
+                if rel in ('obsoletes', 'updates'):
+                    for mnt, size in sizes(oldpo).items():
+                        split[mnt] = split.get(mnt, 0) + size
+            total = sum(split.values())
+            if not total:
+                split, total = {'/usr':1}, 1
+            for mnt, size in split.items():
+                delta[mnt] = delta.get(mnt, 0) + t.po.installedsize*size//total
+        for mnt, size in delta.items():
+            plan.add(mnt, _("install"), max(0, size))
+        newpkgs = [t.po for t in self.tsInfo.getMembers()
+                   if t.output_state == TS_INSTALL]
+        plan.add('/usr', _("install"), 0,
+                 inodes=sum(p.installedsize for p in newpkgs)//bytes_per_inode)
+        # ..and each new kernel gets an initramfs built for it in /boot
+        kernels = [p for p in pkgs if p.name in self.conf.kernelpkgnames]
+        if kernels:
+            plan.add('/boot', _("kernel"), bootsize()*len(kernels),
+                     inodes=2*len(kernels))
+        return plan
+
+    def budget_cache(self, keepfiles, budget, incoming=0, dryrun=False):
+        '''
+        Evict the least-recently-used packages and metadata from the cache
+        until it (plus incoming bytes yet to be downloaded) fits in budget.
+        Nothing in keepfiles or the enabled repos' metadata gets evicted.
+        Returns the EvictionPlan; if dryrun is True, nothing is removed.
+        '''
+        keepfiles = set(keepfiles)
+        activemd = [r.cachedir for r in self.repos.listEnabled()
+                    if not r.mediaid]
+        # this run counts as a use of everything we're keeping (but a dry
+        # run shouldn't change anything, not even atimes)
+        if not dryrun:
+            touch(f for f in keepfiles if os.path.exists(f))
+            touch(os.path.join(d, 'repomd.xml') for d in activemd)
+        plan = EvictionPlan(scan_cache(repodirs(cachedir)), budget,
+                            protect=keepfiles.union(activemd),
+                            incoming=incoming)
+        for line in plan.report():
+            log.info(line)
+        if not dryrun:
+            plan.apply()
+            self.objstore.prune()
+            self.verifycache.prune()
+            self.verifycache.save()
+        return plan
+
     def clean_cache(self, keepfiles):
         log.info("checking for unneeded rpms in cache")
         # Find all the packages in the caches (not on media though)
         localpkgs = set(f for r in self.repos.listEnabled() if not r.mediaid
                           for f in listdir(r.pkgdir) if f.endswith(".rpm"))
+        keepfiles = set(keepfiles)
+        # ...and any leftover partial downloads (see grab.PartialDownload)
+        # or hedged downloads (see engine.DownloadEngine._race)
+        localpkgs.update(f for r in self.repos.listEnabled() if not r.mediaid
+                           for f in listdir(r.pkgdir)
+                           if (f.endswith((".rpm.part", ".rpm.part.state"))
+                               or ".rpm.hedge" in f)
+                           and f[:f.rindex(".rpm")+4] not in keepfiles)
         for f in localpkgs.difference(keepfiles):
             try:
                 log.debug("removing %s", f)
                 os.remove(f)
             except IOError as e:
                 log.info("failed to remove %s", f)
+        # repo dirs in the old layout (see _migrate_repo_cache) that didn't
+        # get moved belong to repos we aren't using, and never will again
+        if self.repocachedir != cachedir:
+            for d in old_repodirs(cachedir):
+                log.debug("removing old cache dir %s", d)
+                rm_rf(d)
+        self.objstore.prune()
+        # forget about anything that's gone or changed since we checked it
+        self.verifycache.prune()
+        self.verifycache.save()
         # TODO remove dirs that don't belong to any repo
 
     def _get_treeinfo(self):
@@ -420,20 +1045,22 @@ class UpgradeDownloader(yum.YumBase):
         # helper function to grab and checksum image files listed in .treeinfo
         def grab_and_check(imgarch, imgtype, outpath):
             relpath = self.treeinfo.get_image(imgarch, imgtype)
+            algo, checksum = self.treeinfo.get_checksum(relpath)
             log.debug("grabbing %s %s", imgarch, imgtype)
             log.info("downloading %s to %s", relpath, outpath)
+            if self.verifycache.lookup(outpath, algo, checksum):
+                log.debug("file already exists and was verified earlier")
+                return outpath
             if self.treeinfo.checkfile(outpath, relpath):
                 log.debug("file already exists and checksum OK")
+                self.verifycache.add(outpath, algo, checksum)
                 return outpath
-            def checkfile(cb):
-                log.debug("checking %s", relpath)
-                if not self.treeinfo.checkfile(cb.filename, relpath):
-                    log.info("checksum doesn't match - retrying")
-                    raise yum.URLGrabError(-1)
-            return self.instrepo.grab.urlgrab(relpath, outpath,
-                                              checkfunc=checkfile,
-                                              reget=None,
-                                              copy_local=True)
+            # the data gets checksummed as it's written, so we don't need
+            # to read the file back in to check it
+            grab_and_hash(self.instrepo.grab, relpath, outpath,
+                          algo, checksum)
+            self.verifycache.add(outpath, algo, checksum)
+            return outpath
 
         # handle special cases for downloading kernel images
         def get_image_arch():
@@ -474,6 +1101,8 @@ class UpgradeDownloader(yum.YumBase):
                 # The exception actually was a KeyBoardInterrupt, re-raise it
                 raise
 
+        self.verifycache.save()
+
         # Save kernel/initrd info so we can clean it up later
         mkdir_p(os.path.dirname(upgradeconf))
         with Config(upgradeconf) as conf:
@@ -482,11 +1111,36 @@ class UpgradeDownloader(yum.YumBase):
 
         return kernel, initrd
 
+    def verifyPkg(self, fo, po, raiseError):
+        '''like YumBase.verifyPkg(), but also starts the signature check
+           for the package if it passes.'''
+        ok = yum.YumBase.verifyPkg(self, fo, po, raiseError)
+        if ok and self._sigcheck and self._need_sigcheck(po):
+            self._sigcheck.submit(po)
+        return ok
+
+    def _need_sigcheck(self, po):
+        if self._override_sigchecks:
+            return False
+        return bool(self.repos.getRepo(po.repoid).gpgcheck)
+
     def _checkSignatures(self, pkgs, callback):
         '''check the package signatures and get keys if needed.
            works like YumBase._checkSignatures() except it only uses our
-           special automatic _GPGKeyCheck to import untrusted keys.'''
+           special automatic _GPGKeyCheck to import untrusted keys.
+           if the signature checkers are running, packages they've already
+           passed are skipped; everything else gets checked here, one at a
+           time, since importing keys may require user interaction.'''
+        sigcheck = self._sigcheck
+        if sigcheck and sigcheck.failed:
+            # cancel the rest and check the bad one first, so we bail out
+            # on the first hard failure without waiting for anything else
+            sigcheck.close()
+            failed = sigcheck.failed
+            pkgs = [failed] + [po for po in pkgs if po != failed]
         for po in pkgs:
+            if sigcheck and sigcheck.result(po) == 0:
+                continue
             result, errmsg = self.sigCheckPkg(po)
             if result == 0:
                 continue
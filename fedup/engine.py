@@ -0,0 +1,802 @@
+# engine.py - package downloader using pooled keep-alive connections
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A simple download engine for lots of small files.
+
+urlgrabber sets up a new connection (and TLS session) for more or less
+every file, which is most of the time spent fetching a couple thousand
+small RPMs. This keeps a pool of idle HTTP/1.1 keep-alive connections for
+each mirror host, and runs a fixed number of downloads at once across all
+of them.
+
+How many of those downloads go to each host is adjusted as we go (AIMD,
+like TCP congestion control): every host starts with a couple of slots and
+gets one more for each window of successful transfers, and the number is
+cut in half when the host returns an error or its throughput collapses.
+Jobs that don't fit on their preferred mirror spill over to the next one.
+
+Optionally, downloads can also be "hedged": if a transfer doesn't make any
+progress for a while, the same file is requested from the next mirror too,
+and whichever copy finishes first wins.
+
+Big files can also be fetched in several byte ranges at once, each from a
+different mirror (see fetch_segmented).
+
+We don't do proxies, client certificates, custom CAs or logins, so repos
+that need any of those (see can_fetch) are left to urlgrabber.
+'''
+
+import os, ssl, time, socket, httplib, urllib, urlparse
+from threading import Thread, Lock, Condition, Event
+from Queue import Queue, Empty
+
+from .grab import HashingSink, PartialDownload, join_url
+from .treeinfo import hexdigest
+from .util import hrsize, rm_f
+from .version import version
+
+import logging
+log = logging.getLogger(__package__+".engine")
+# throttling decisions go to the same log as the rest of the mirror stuff
+mirrorlog = logging.getLogger(__package__+".yum")
+
+useragent = "%s/%s" % (__package__, version)
+redirect_codes = (301, 302, 303, 307, 308)
+
+class FetchError(Exception):
+    def __init__(self, msg, status=None):
+        Exception.__init__(self, msg)
+        self.status = status
+
+class RangeNotSupported(FetchError):
+    pass
+
+class Job(object):
+    '''A file to download from one of the given mirror urls.'''
+    def __init__(self, urls, relpath, outpath, algo, checksum, size=None,
+                 data=None):
+        self.urls = urls
+        self.relpath = relpath
+        self.outpath = outpath
+        self.algo = algo
+        self.checksum = checksum
+        self.size = size
+        self.data = data
+        self.done = False
+        self.errors = []
+
+class Attempt(object):
+    '''One of several racing downloads of the same Job (see _race).'''
+    def __init__(self, job, url, pool, outpath, hedge=False, rivals=None):
+        self.job = job
+        self.url = url
+        self.pool = pool
+        self.outpath = outpath
+        self.hedge = hedge
+        self.rivals = rivals if rivals is not None else []
+        self.rivals.append(self)
+        self.started = self.progress = time.time()
+        self.partial = None
+        self.received = 0 # bytes downloaded by this attempt
+        self.remaining = None # bytes left to go, if we know
+        self.hedged = False
+        self.cancelled = False
+        self.finished = False
+        self.won = False
+
+    def stalled(self, deadline, now=None):
+        return (now or time.time()) - self.progress > deadline
+
+    def projected_finish(self):
+        '''
+        when this attempt would finish at the rate it's gone so far, or None
+        if it hasn't gotten far enough to tell
+        '''
+        if not self.received or self.remaining is None:
+            return None
+        elapsed = self.progress - self.started
+        return self.progress + elapsed * self.remaining / self.received
+
+    def discard(self):
+        '''remove this attempt's files (but never the job's outpath)'''
+        rm_f(self.outpath + '.part')
+        rm_f(self.outpath + '.part.state')
+        if self.outpath != self.job.outpath:
+            rm_f(self.outpath)
+
+class Segment(object):
+    '''one byte range of a segmented download'''
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.done = 0
+        self.error = None
+
+    def __len__(self):
+        return self.end - self.start
+
+def split_ranges(size, segments):
+    '''split size bytes into (start, end) ranges of roughly equal size'''
+    segsize = -(-size // segments) # round up
+    return [(start, min(start+segsize, size))
+            for start in range(0, size, segsize)]
+
+def engine_urls(repo, urls=None):
+    '''
+    the URLs from urls (default: repo.urls) that we can download from with
+    the same security settings urlgrabber would use for repo.
+    '''
+    def usable(url):
+        if url.startswith('http://'):
+            return True
+        if not url.startswith('https://'):
+            return False
+        # older pythons don't check certificates at all, and we don't do
+        # custom CAs or client certs. Skipping these mirrors is fine - the
+        # packages get checksummed either way.
+        if repo.sslcacert or repo.sslclientcert or repo.sslclientkey:
+            return False
+        return repo.sslverify and hasattr(ssl, 'create_default_context')
+    return [u for u in (repo.urls if urls is None else urls) if usable(u)]
+
+def can_fetch(repo):
+    '''
+    True if we can download from repo with the same network and security
+    settings urlgrabber would use for it.
+    '''
+    urls = engine_urls(repo)
+    if repo.mediaid or not urls:
+        return False
+    if repo.proxy and repo.proxy != '_none_':
+        return False
+    if any(urllib.getproxies().get(urlparse.urlsplit(u).scheme)
+           for u in urls):
+        return False
+    if repo.username or repo.password or \
+            any(urlparse.urlsplit(u).username for u in urls):
+        return False
+    return True
+
+def pkg_job(po):
+    '''make a Job for the given yum package object'''
+    (csum_type, csum) = po.returnIdSum()
+    urls = engine_urls(po.repo)
+    return Job(urls, po.relativepath, po.localPkg(), csum_type, csum,
+               size=int(po.packagesize), data=po)
+
+def md_job(repo, mdtype):
+    '''
+    make a Job for the given metadata type of a yum repo, which writes the
+    file where repo.retrieveMD() will look for it
+    '''
+    data = repo.repoXML.getData(mdtype)
+    (base, relpath) = data.location
+    (csum_type, csum) = data.checksum
+    urls = engine_urls(repo, [base] if base else None)
+    outpath = os.path.join(repo.cachedir, os.path.basename(relpath))
+    return Job(urls, relpath, outpath, csum_type, csum,
+               size=int(data.size) if data.size else None, data=repo)
+
+class HostPool(object):
+    '''
+    idle keep-alive connections to a single host, plus the stats and
+    concurrency limit for that host.
+    '''
+    initial_limit = 2
+    # a transfer this big going at less than slow_factor of the host's usual
+    # rate means we're asking too much of it
+    slow_size = 1024*1024
+    slow_factor = 0.5
+    # weight of each new sample in the moving average
+    rate_alpha = 0.3
+
+    def __init__(self, scheme, netloc, timeout=30, maxlimit=10):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self._idle = []
+        self._lock = Lock()
+        # these are protected by the engine's lock, not ours
+        self.maxlimit = max(1, maxlimit)
+        self.limit = min(self.initial_limit, self.maxlimit)
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.rate = None
+        self._credit = 0.0
+
+    def get(self):
+        '''return (conn, reused): an idle connection if we have one,
+        otherwise a new one'''
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.netloc, timeout=self.timeout,
+                                    context=ssl.create_default_context())
+        else:
+            conn = httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+        return conn, False
+
+    def put(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+    def _decrease(self, why):
+        newlimit = max(1, self.limit // 2)
+        if newlimit != self.limit:
+            mirrorlog.info("%s: %s; cutting connections %u -> %u",
+                           self.netloc, why, self.limit, newlimit)
+        self.limit = newlimit
+        self._credit = 0.0
+
+    def success(self, nbytes, elapsed):
+        '''record a finished transfer and adjust the limit to match'''
+        self.requests += 1
+        self.bytes += nbytes
+        self.elapsed += elapsed
+        sample = nbytes / max(elapsed, 0.001)
+        if self.rate is None:
+            self.rate = sample
+        elif nbytes >= self.slow_size and \
+                sample < self.rate * self.slow_factor and self.limit > 1:
+            self._decrease("throughput dropped to %s/s (avg %s/s)" %
+                           (hrsize(sample), hrsize(self.rate)))
+        else:
+            # additive increase: one more slot per window of good transfers
+            self._credit += 1.0 / self.limit
+            if self._credit >= 1.0 and self.limit < self.maxlimit:
+                self._credit = 0.0
+                self.limit += 1
+                mirrorlog.debug("%s: raising connections to %u (%s/s)",
+                                self.netloc, self.limit, hrsize(self.rate))
+        self.rate += self.rate_alpha * (sample - self.rate)
+
+    def failure(self, err):
+        '''record a failed transfer and back off'''
+        self.requests += 1
+        self.errors += 1
+        self._decrease("error (%s)" % err)
+
+    @property
+    def url(self):
+        return "%s://%s/" % (self.scheme, self.netloc)
+
+    @property
+    def avgrate(self):
+        '''average throughput per connection (bytes/sec)'''
+        return self.bytes / self.elapsed if self.elapsed else 0
+
+    def summary(self):
+        return "%s: %u requests, %u errors, %s at %s/s, %u connections" % \
+                (self.netloc, self.requests, self.errors, hrsize(self.bytes),
+                 hrsize(self.avgrate), self.limit)
+
+class DownloadEngine(object):
+    '''
+    Download a bunch of Jobs with at most maxconn requests in flight.
+    Each host gets a share of those that grows and shrinks with how well
+    it's doing (see HostPool).
+
+    multi_progress can be an urlgrabber MultiFileMeter (e.g. the
+    RepoMultiProgress used for repo metadata) to show progress.
+
+    If hedge_after is set, a download that gets no data for that many
+    seconds is also started on the next mirror; see hedge_stats for how
+    that went.
+    '''
+    def __init__(self, maxconn=10, timeout=30, blocksize=65536,
+                 multi_progress=None, hedge_after=None):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.blocksize = blocksize
+        self.multi_progress = multi_progress
+        self.hedge_after = hedge_after
+        # fired: hedges started, won: hedges that finished first,
+        # saved: seconds between a hedge winning and when the download it
+        # replaced would have finished, going at the rate it had managed
+        # so far (downloads that never got any data don't count)
+        self.hedge_stats = dict(fired=0, won=0, saved=0.0)
+        self._pools = dict()
+        self._lock = Lock()
+        self._slots = Condition(self._lock)
+        self._queue = Queue()
+        self._callback = None
+
+    def _getpool(self, url):
+        '''return (pool, path) for url. call with self._lock held.'''
+        u = urlparse.urlsplit(url)
+        key = (u.scheme, u.netloc)
+        if key not in self._pools:
+            self._pools[key] = HostPool(u.scheme, u.netloc, self.timeout,
+                                        self.maxconn)
+        path = u.path + ('?' + u.query if u.query else '')
+        return self._pools[key], path
+
+    def _hostpool(self, url):
+        with self._lock:
+            return self._getpool(url)
+
+    def _request(self, url, headers, redirects=5):
+        '''send a GET for url, returning (pool, conn, response)'''
+        pool, path = self._hostpool(url)
+        conn, reused = pool.get()
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # the server probably closed the idle connection; try another
+            return self._request(url, headers, redirects)
+        if resp.status in redirect_codes and redirects:
+            location = resp.getheader('location')
+            self._release(pool, conn, resp, drain=True)
+            log.debug("%s redirected to %s", url, location)
+            return self._request(urlparse.urljoin(url, location), headers,
+                                 redirects-1)
+        if resp.status not in (200, 206):
+            self._release(pool, conn, resp, drain=True)
+            raise FetchError("HTTP error %u: %s" % (resp.status, resp.reason),
+                             resp.status)
+        return pool, conn, resp
+
+    def _release(self, pool, conn, resp, drain=False):
+        '''put conn back in the pool if it can be reused, else close it'''
+        if drain:
+            try:
+                resp.read()
+            except (httplib.HTTPException, socket.error):
+                resp.will_close = True
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+        else:
+            pool.put(conn)
+
+    def _fetch(self, job, url, meter=None, attempt=None):
+        '''
+        download job from url, resuming a partial download if possible.
+        if attempt is given, download to attempt.outpath instead, and give
+        up as soon as a rival attempt wins.
+        '''
+        outpath = attempt.outpath if attempt else job.outpath
+        partial = PartialDownload(outpath, job.algo, job.checksum)
+        if attempt:
+            attempt.partial = partial
+        headers = {'User-Agent': useragent, 'Accept-Encoding': 'identity'}
+        if partial.offset:
+            headers['Range'] = 'bytes=%u-' % partial.offset
+            if partial.validator and partial.url == url:
+                headers['If-Range'] = partial.validator
+        try:
+            pool, conn, resp = self._request(url, headers)
+        except FetchError as e:
+            if e.status == 416: # range not satisfiable
+                partial.discard()
+            raise
+        offset = partial.offset if resp.status == 206 else 0
+        partial.url = url
+        partial.validator = resp.getheader('etag') or \
+                            resp.getheader('last-modified')
+        length = resp.getheader('content-length')
+        expected = offset + int(length) if length else None
+        if attempt and expected is not None:
+            attempt.remaining = expected - offset
+        try:
+            with HashingSink(partial.partpath, job.algo, offset) as sink:
+                try:
+                    while True:
+                        data = resp.read(self.blocksize)
+                        if not data:
+                            break
+                        sink.write(data)
+                        if attempt:
+                            attempt.progress = time.time()
+                            attempt.received += len(data)
+                            if attempt.remaining is not None:
+                                attempt.remaining -= len(data)
+                            if attempt.cancelled:
+                                raise FetchError("cancelled")
+                        if meter:
+                            meter.update(sink.size)
+                finally:
+                    self._save(partial, sink, attempt)
+                filesum = sink.hexdigest()
+                size = sink.size
+        except (FetchError, httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        self._release(pool, conn, resp)
+        if expected is not None and size < expected:
+            raise FetchError("connection closed after %u of %u bytes" %
+                             (size, expected))
+        if filesum != job.checksum:
+            partial.discard()
+            raise FetchError("checksum doesn't match")
+        if attempt and not self._claim(attempt):
+            raise FetchError("cancelled")
+        partial.finish()
+        if outpath != job.outpath:
+            os.rename(outpath, job.outpath)
+        return size - offset
+
+    def _fetch_segment(self, seg, urls, partpath):
+        '''
+        fetch seg into its place in partpath, trying each of the urls in
+        turn. runs in its own thread; errors are saved in seg.error.
+        '''
+        headers = {'User-Agent': useragent, 'Accept-Encoding': 'identity',
+                   'Range': 'bytes=%u-%u' % (seg.start, seg.end-1)}
+        errors = []
+        for url in urls:
+            url, pool = self._acquire([url])
+            seg.done = 0
+            start = time.time()
+            try:
+                hostpool, conn, resp = self._request(url, headers)
+            except (FetchError, httplib.HTTPException, socket.error) as e:
+                self._done(pool, err=e)
+                log.info("%s: %s", url, e)
+                errors.append((url, str(e)))
+                continue
+            crange = resp.getheader('content-range') or ''
+            if resp.status != 206 or \
+                    not crange.startswith('bytes %u-' % seg.start):
+                conn.close()
+                self._done(pool)
+                seg.error = RangeNotSupported(url)
+                return
+            try:
+                with open(partpath, 'r+b') as outf:
+                    outf.seek(seg.start)
+                    while seg.done < len(seg):
+                        data = resp.read(min(self.blocksize,
+                                             len(seg) - seg.done))
+                        if not data:
+                            break
+                        outf.write(data)
+                        seg.done += len(data)
+            except (httplib.HTTPException, socket.error, IOError) as e:
+                conn.close()
+                self._done(pool, err=e)
+                log.info("%s: %s", url, e)
+                errors.append((url, str(e)))
+                continue
+            if seg.done == len(seg):
+                self._release(hostpool, conn, resp)
+                self._done(pool, seg.done, time.time() - start)
+                return
+            conn.close()
+            self._done(pool, err="short read")
+            errors.append((url, "short read (%u of %u bytes)" %
+                                (seg.done, len(seg))))
+        seg.error = FetchError("no more mirrors to try (%s)" %
+                               "; ".join("%s: %s" % e for e in errors))
+
+    def fetch_segmented(self, job, segments=4, progress=None):
+        '''
+        Download job in several byte ranges at once, each starting on a
+        different mirror, then check the result against job's checksum.
+        Returns True if that worked. If it didn't (say, a mirror doesn't
+        do Range requests) nothing is left behind, so the file can be
+        fetched the usual way instead.
+
+        progress, if given, gets called as progress(amount, total) every
+        so often while the segments are downloading.
+        '''
+        ranges = split_ranges(job.size, segments)
+        urls = [join_url(u, job.relpath) for u in job.urls]
+        if len(ranges) < 2 or not urls:
+            return False
+        log.info("downloading %s in %u segments from %u mirrors",
+                 job.relpath, len(ranges), min(len(ranges), len(urls)))
+        partpath = job.outpath + '.part'
+        rm_f(partpath + '.state') # the segments don't use PartialDownload
+        with open(partpath, 'wb') as outf:
+            outf.truncate(job.size)
+        segs = []
+        threads = []
+        for n, (start, end) in enumerate(ranges):
+            seg = Segment(start, end)
+            # start each segment on a different mirror
+            k = n % len(urls)
+            t = Thread(target=self._fetch_segment, name='segment-%u' % n,
+                       args=(seg, urls[k:] + urls[:k], partpath))
+            t.daemon = True
+            t.start()
+            segs.append(seg)
+            threads.append(t)
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5) # timeout so Ctrl-C still works
+                if progress:
+                    progress(sum(seg.done for seg in segs), job.size)
+        failed = [seg.error for seg in segs if seg.error]
+        if not failed and hexdigest(partpath, job.algo) == job.checksum:
+            os.rename(partpath, job.outpath)
+            job.done = True
+            return True
+        norange = [e for e in failed if isinstance(e, RangeNotSupported)]
+        if norange:
+            log.info("%s: mirror doesn't support ranges", norange[0])
+        elif failed:
+            log.info("segmented download of %s failed: %s",
+                     job.relpath, failed[0])
+        else:
+            log.info("checksum doesn't match for segmented download of %s",
+                     job.relpath)
+        job.errors += [(job.relpath, str(e)) for e in failed]
+        rm_f(partpath)
+        return False
+
+    def _acquire(self, urls):
+        '''
+        wait for a free slot on the host for one of the given urls (trying
+        them in order) and return (url, pool)
+        '''
+        with self._slots:
+            while True:
+                for url in urls:
+                    pool, path = self._getpool(url)
+                    if pool.inflight < pool.limit:
+                        pool.inflight += 1
+                        return url, pool
+                self._slots.wait(0.5) # timeout so Ctrl-C still works
+
+    def _tryacquire(self, urls):
+        '''like _acquire, but return (None, None) if all the hosts are busy'''
+        with self._slots:
+            for url in urls:
+                pool, path = self._getpool(url)
+                if pool.inflight < pool.limit:
+                    pool.inflight += 1
+                    return url, pool
+        return None, None
+
+    def _done(self, pool, nbytes=None, elapsed=None, err=None):
+        '''
+        give back the slot from _acquire and record how it went.
+        if neither nbytes nor err is given, the result doesn't count.
+        '''
+        with self._slots:
+            pool.inflight -= 1
+            if err is not None:
+                pool.failure(err)
+            elif nbytes is not None:
+                pool.success(nbytes, elapsed)
+            self._slots.notify_all()
+
+    def _save(self, partial, sink, attempt=None):
+        '''
+        save partial's state, unless attempt has been cancelled - _race
+        might have discarded its files already, and we'd leave a stray
+        .part.state behind.
+        '''
+        if attempt is None:
+            partial.save(sink)
+            return
+        # NOTE: _claim cancels the losers with the lock held, so either
+        # we see that here or _race does its cleanup after we're done.
+        with self._lock:
+            if not attempt.cancelled:
+                partial.save(sink)
+
+    def _claim(self, attempt):
+        '''
+        mark attempt's job done and cancel its rivals. returns False if some
+        other attempt already got there first.
+        '''
+        with self._lock:
+            job = attempt.job
+            if job.done or attempt.cancelled:
+                return False
+            job.done = True
+            attempt.won = True
+            now = time.time()
+            for a in attempt.rivals:
+                if a is not attempt:
+                    a.cancelled = True
+                    finish = a.projected_finish()
+                    if attempt.hedge and not a.finished and \
+                            finish is not None and finish > now:
+                        self.hedge_stats['saved'] += finish - now
+            if attempt.hedge:
+                self.hedge_stats['won'] += 1
+            return True
+
+    def _attempt(self, attempt, meter, event):
+        '''run one attempt from _race. runs in its own thread.'''
+        job = attempt.job
+        try:
+            nbytes = self._fetch(job, attempt.url, meter, attempt)
+        except Exception as e:
+            if attempt.cancelled:
+                attempt.discard()
+            else:
+                log.info("%s: %s", attempt.url, e)
+                job.errors.append((attempt.url, str(e)))
+            # losing to a hedge means we were stalled, so that counts
+            # against the host; losing to a stalled attempt doesn't.
+            if not attempt.cancelled:
+                self._done(attempt.pool, err=e)
+            elif attempt.hedged:
+                self._done(attempt.pool, err="stalled")
+            else:
+                self._done(attempt.pool)
+        else:
+            self._done(attempt.pool, nbytes, time.time() - attempt.started)
+        finally:
+            attempt.finished = True
+            event.set()
+
+    def _race(self, job, urls, meter):
+        '''
+        download job, failing over through urls like _failover does, but also
+        start a download from the next url if the current one stalls for
+        more than hedge_after seconds.
+        '''
+        attempts = []
+        event = Event()
+        def start(url, pool, hedge):
+            outpath = job.outpath
+            if any(not a.finished and a.outpath == outpath for a in attempts):
+                outpath = "%s.hedge%u" % (job.outpath, len(attempts))
+            a = Attempt(job, url, pool, outpath, hedge, attempts)
+            t = Thread(target=self._attempt, name='hedge-%s' % job.relpath,
+                       args=(a, meter if not hedge else None, event))
+            t.daemon = True
+            t.start()
+        while not job.done:
+            running = [a for a in attempts if not a.finished]
+            if not running:
+                if not urls:
+                    break
+                url, pool = self._acquire(urls)
+                urls.remove(url)
+                start(url, pool, hedge=False)
+                continue
+            now = time.time()
+            stalled = [a for a in running if not a.hedged and
+                                             a.stalled(self.hedge_after, now)]
+            if stalled and urls:
+                url, pool = self._tryacquire(urls)
+                if url:
+                    log.info("%s stalled, also trying %s", job.relpath, url)
+                    for a in stalled:
+                        a.hedged = True
+                    urls.remove(url)
+                    with self._lock:
+                        self.hedge_stats['fired'] += 1
+                    start(url, pool, hedge=True)
+            event.wait(min(0.5, self.hedge_after))
+            event.clear()
+        # clean up after the losers now, rather than whenever they notice
+        # they've lost (a stalled one might never). if nobody won, keep the
+        # first attempt's partial download so the next run can resume it.
+        for a in attempts:
+            if a.won or (not job.done and a.outpath == job.outpath):
+                continue
+            a.discard()
+
+    def hosts(self):
+        '''the HostPool (and stats) for each host we've talked to'''
+        with self._lock:
+            return self._pools.values()
+
+    def hedge_summary(self):
+        with self._lock:
+            s = dict(self.hedge_stats)
+        return "hedged %u stalled downloads, %u finished first, " \
+               "saving about %.1fs" % (s['fired'], s['won'], s['saved'])
+
+    def _run(self, job):
+        meter = None
+        if self.multi_progress:
+            meter = self.multi_progress.newMeter()
+            meter.start(text=os.path.basename(job.outpath), size=job.size)
+        urls = [join_url(u, job.relpath) for u in job.urls]
+        if self.hedge_after:
+            self._race(job, urls, meter)
+        else:
+            self._failover(job, urls, meter)
+        if meter:
+            if job.done:
+                meter.end(job.size)
+            else:
+                meter.failure("no more mirrors to try")
+
+    def _failover(self, job, urls, meter):
+        '''download job from each of urls in turn until one works'''
+        while urls:
+            url, pool = self._acquire(urls)
+            urls.remove(url)
+            start = time.time()
+            try:
+                nbytes = self._fetch(job, url, meter)
+            except (FetchError, httplib.HTTPException,
+                    socket.error, IOError) as e:
+                self._done(pool, err=e)
+                log.info("%s: %s", url, e)
+                job.errors.append((url, str(e)))
+                continue
+            except Exception as e:
+                self._done(pool, err=e)
+                raise
+            self._done(pool, nbytes, time.time() - start)
+            job.done = True
+            break
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Empty:
+                return
+            try:
+                self._run(job)
+            except Exception as e:
+                log.info("unexpected error fetching %s", job.relpath,
+                         exc_info=True)
+                job.errors.append((job.relpath, str(e)))
+            if self._callback:
+                self._callback(job)
+
+    def fetch_all(self, jobs, callback=None):
+        '''download all the given jobs; returns the list of jobs.
+        check job.done (and job.errors) to see how each one went.
+        if callback is given, it's called (from a worker thread) with each
+        job as soon as it's finished.'''
+        jobs = list(jobs)
+        if not jobs:
+            return jobs
+        self._callback = callback
+        for job in jobs:
+            self._queue.put(job)
+        if self.multi_progress:
+            self.multi_progress.start(len(jobs),
+                                      sum(j.size or 0 for j in jobs))
+        threads = []
+        for n in range(min(self.maxconn, len(jobs))):
+            t = Thread(target=self._worker, name='download-%u' % n)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5) # timeout so Ctrl-C still works
+        if self.multi_progress:
+            self.multi_progress.end()
+        self.close()
+        if self.hedge_after:
+            log.info(self.hedge_summary())
+        return jobs
+
+    def close(self):
+        '''close the idle connections, and log how each host did'''
+        for pool in self.hosts():
+            mirrorlog.debug(pool.summary())
+            pool.close()
@@ -0,0 +1,275 @@
+# grab.py - download helpers that checksum data as it arrives
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, json, hashlib
+from urlgrabber.grabber import URLGrabError
+
+from .util import rm_f
+
+import logging
+log = logging.getLogger(__package__+".grab")
+
+class HashingSink(object):
+    '''
+    A write-only file-like object that checksums everything written to it.
+    Use it as the destination for a download and you get the checksum for
+    free, instead of reading the whole file back in afterward.
+
+    If offset is nonzero, the first offset bytes of the existing file are
+    kept (and checksummed) and new data is written after them.
+    '''
+    def __init__(self, filename, algo, offset=0, blocksize=65536):
+        self.filename = filename
+        self.hasher = hashlib.new(algo)
+        self.size = 0
+        if offset:
+            self._fobj = open(filename, 'r+b')
+            while self.size < offset:
+                data = self._fobj.read(min(blocksize, offset - self.size))
+                if not data:
+                    break
+                self.hasher.update(data)
+                self.size += len(data)
+            self._fobj.seek(self.size)
+            self._fobj.truncate()
+        else:
+            self._fobj = open(filename, 'wb')
+
+    def write(self, data):
+        self.hasher.update(data)
+        self._fobj.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self._fobj.flush()
+        os.fsync(self._fobj.fileno())
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def close(self):
+        self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PartialDownload(object):
+    '''
+    Bookkeeping for a download that might get interrupted.
+
+    Data gets written to outpath.part, and outpath.part.state records how
+    much of that is safely on disk, what the finished file's checksum
+    should be, and where the data came from. If the download is
+    interrupted, the next attempt continues where this one left off, using
+    a HTTP Range request.
+
+    NOTE: python can't save/restore hash state, so the data we already
+    have gets checksummed again when we resume. That's a local sequential
+    read, which is a lot cheaper than downloading it again.
+    '''
+    save_interval = 4*1024*1024
+
+    def __init__(self, outpath, algo, checksum):
+        self.outpath = outpath
+        self.partpath = outpath + '.part'
+        self.statepath = self.partpath + '.state'
+        self.algo = algo
+        self.checksum = checksum
+        self.offset = 0
+        self.url = None
+        self.validator = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.statepath) as inf:
+                state = json.load(inf)
+            partsize = os.path.getsize(self.partpath)
+        except (IOError, OSError, ValueError):
+            return
+        if (state.get('algo'), state.get('checksum')) != \
+                (self.algo, self.checksum):
+            log.debug("discarding stale partial file %s", self.partpath)
+            self.discard()
+            return
+        self.offset = min(state.get('offset', 0), partsize)
+        self.url = state.get('url')
+        self.validator = state.get('validator')
+        if self.offset:
+            log.info("resuming %s at %u bytes", self.outpath, self.offset)
+
+    def claim(self):
+        '''
+        Record that whatever's in the .part file belongs to this download,
+        for downloaders (like urlgrabber's reget) that just append to it.
+        Returns the size of the .part file.
+        '''
+        try:
+            self.offset = os.path.getsize(self.partpath)
+        except OSError:
+            self.offset = 0
+        self._write_state()
+        return self.offset
+
+    def save(self, sink):
+        '''record how much of the data is safely on disk'''
+        sink.flush()
+        self.offset = sink.size
+        self._write_state()
+
+    def _write_state(self):
+        state = dict(algo=self.algo, checksum=self.checksum,
+                     offset=self.offset, url=self.url,
+                     validator=self.validator)
+        with open(self.statepath, 'w') as outf:
+            json.dump(state, outf)
+
+    def discard(self):
+        self.offset = 0
+        self.url = None
+        self.validator = None
+        rm_f(self.partpath)
+        rm_f(self.statepath)
+
+    def finish(self):
+        os.rename(self.partpath, self.outpath)
+        rm_f(self.statepath)
+
+def join_url(base, relpath):
+    '''join a mirror URL and a relative path like MirrorGroup does'''
+    if base.endswith('/') or relpath.startswith('/'):
+        return base + relpath
+    return base + '/' + relpath
+
+def is_http(url):
+    return url.startswith(('http://', 'https://'))
+
+class HashingProgress(object):
+    '''
+    A urlgrabber progress_obj that checksums the file being downloaded as it
+    gets written, by reading back each new piece while it's still in the
+    page cache. Everything gets passed along to meter (the usual progress
+    meter), if there is one.
+
+    urlgrabber calls start() when the data starts arriving - after it
+    truncates the file, if the server ignored a Range request - so we
+    start over from the beginning of the file there. When resuming, that
+    means the part we already had gets read and checksummed again.
+    '''
+    def __init__(self, filename, algo, meter=None, blocksize=65536):
+        self.filename = filename
+        self.algo = algo
+        self.meter = meter
+        self.blocksize = blocksize
+        self._fobj = None
+        self._reset()
+
+    def _reset(self):
+        self.close()
+        self.hasher = hashlib.new(self.algo)
+        self.size = 0
+
+    def _catch_up(self):
+        '''checksum whatever has been written since last time'''
+        if self._fobj is None:
+            try:
+                self._fobj = open(self.filename, 'rb')
+            except IOError:
+                return
+        self._fobj.seek(self.size)
+        while True:
+            data = self._fobj.read(self.blocksize)
+            if not data:
+                break
+            self.hasher.update(data)
+            self.size += len(data)
+
+    def hexdigest(self):
+        self._catch_up()
+        return self.hasher.hexdigest()
+
+    def close(self):
+        if self._fobj:
+            self._fobj.close()
+            self._fobj = None
+
+    def start(self, *args, **kwargs):
+        self._reset()
+        if self.meter:
+            self.meter.start(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self._catch_up()
+        if self.meter:
+            self.meter.update(*args, **kwargs)
+
+    def end(self, *args, **kwargs):
+        if self.meter:
+            self.meter.end(*args, **kwargs)
+
+    def failure(self, *args, **kwargs):
+        if self.meter and hasattr(self.meter, 'failure'):
+            self.meter.failure(*args, **kwargs)
+
+def grab_and_hash(mirrorgroup, relpath, outpath, algo, checksum,
+                  text=None, retries=3):
+    '''
+    Download relpath to outpath with the given MirrorGroup (e.g. repo.grab),
+    checksumming the data as it arrives (see HashingProgress). If the
+    checksum doesn't match, the checkfunc fails and MirrorGroup retries and
+    moves on to the next mirror, just like any other failed download.
+
+    The data goes to outpath.part (see PartialDownload) and interrupted
+    downloads are resumed with a Range request - from the next mirror, or
+    on the next run. As long as we're making progress we'll go through the
+    mirror list up to 'retries' times.
+
+    Returns outpath, or raises the URLGrabError from the last attempt.
+    '''
+    partial = PartialDownload(outpath, algo, checksum)
+    hasher = HashingProgress(partial.partpath, algo,
+                             mirrorgroup.grabber.opts.progress_obj)
+    def checkfile(cb):
+        if hasher.hexdigest() != checksum:
+            log.info("checksum doesn't match - retrying")
+            partial.discard()
+            raise URLGrabError(-1, "checksum doesn't match")
+    for attempt in range(retries):
+        start = partial.claim()
+        try:
+            mirrorgroup.urlgrab(relpath, partial.partpath,
+                                reget='simple', copy_local=True,
+                                checkfunc=checkfile, progress_obj=hasher,
+                                text=text or relpath)
+        except URLGrabError as e:
+            # keep going if we got some more data, or if we had some to
+            # begin with (maybe the mirrors couldn't resume; start over)
+            if attempt+1 < retries and os.path.exists(partial.partpath) \
+                    and os.path.getsize(partial.partpath) > start:
+                continue
+            if attempt+1 < retries and start:
+                log.info("%s: couldn't resume, starting over", relpath)
+                partial.discard()
+                continue
+            raise
+        finally:
+            hasher.close()
+        partial.finish()
+        return outpath
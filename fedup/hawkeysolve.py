@@ -0,0 +1,246 @@
+# hawkeysolve.py - depsolve the upgrade with libsolv (via hawkey)
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+An alternate depsolver for build_update_transaction(), using libsolv.
+
+yum's depsolver is single-threaded Python, and for a full system upgrade
+it's most of our runtime. This loads the same repo metadata (and the
+rpmdb) into a hawkey Sack, asks libsolv to upgrade everything and install
+the --add-install items, and then puts the result into yum's tsInfo, so
+everything after depsolving works exactly the same.
+
+yum excludes and plugins (e.g. blacklist/whiteout) don't apply here, and
+groups (@group) can't be used with --add-install (we give up and let yum
+handle those), so use compare_solvers() (or tools/comparesolvers) to check
+the results.
+
+With lazy_filelists, the repos' filelists are only loaded if some package
+has a file dependency that the file lists in primary can't satisfy, like
+yum's doSackFilelistPopulate().
+'''
+
+import os
+from yum.constants import TS_UPDATED, TS_OBSOLETED
+
+try:
+    import hawkey
+except ImportError:
+    hawkey = None
+
+import logging
+log = logging.getLogger(__package__+".hawkeysolve")
+
+class SolverError(Exception):
+    pass
+
+def available():
+    return hawkey is not None
+
+def _md_path(repo, mdtype):
+    '''local path to repo's metadata of the given type, or None'''
+    if mdtype not in repo.repoXML.fileTypes():
+        return None
+    return repo.retrieveMD(mdtype)
+
+def make_sack(yumobj, cachedir, filelists=True):
+    '''
+    load the rpmdb and the enabled repos into a hawkey Sack. if filelists is
+    False, only the file lists from primary get loaded.
+    '''
+    sack = hawkey.Sack(cachedir=cachedir, make_cache_dir=True,
+                       arch=yumobj.arch.canonarch)
+    try:
+        sack.installonly = yumobj.conf.installonlypkgs
+        sack.installonly_limit = yumobj.conf.installonly_limit
+    except AttributeError:
+        pass # older hawkey
+    sack.load_system_repo()
+    for repo in yumobj.repos.listEnabled():
+        hrepo = hawkey.Repo(repo.id)
+        hrepo.repomd_fn = os.path.join(repo.cachedir, 'repomd.xml')
+        hrepo.primary_fn = _md_path(repo, 'primary')
+        if hrepo.primary_fn is None:
+            raise SolverError("%s has no primary metadata" % repo.id)
+        load_filelists = False
+        if filelists:
+            hrepo.filelists_fn = _md_path(repo, 'filelists')
+            load_filelists = bool(hrepo.filelists_fn)
+        sack.load_yum_repo(hrepo, load_filelists=load_filelists)
+    return sack
+
+def missing_filedeps(sack):
+    '''
+    file dependencies of the available packages that nothing in sack
+    provides - without the filelists, that probably means they're in the
+    part of the file lists primary leaves out.
+    '''
+    provided = dict()
+    for pkg in sack.query().filter(reponame__neq=hawkey.SYSTEM_REPO_NAME):
+        for req in pkg.requires:
+            dep = str(req)
+            if dep.startswith('/') and dep not in provided:
+                provided[dep] = bool(sack.query().filter(provides=req).count()
+                                  or sack.query().filter(file=dep).count())
+    return [dep for dep, ok in provided.items() if not ok]
+
+def _selector(sack, pattern):
+    if hasattr(hawkey, 'Subject'):
+        return hawkey.Subject(pattern).get_best_selector(sack)
+    return hawkey.Selector(sack).set(name=pattern)
+
+def solve(yumobj, sack, add_install=[]):
+    '''run the goal; return the finished hawkey Goal'''
+    goal = hawkey.Goal(sack)
+    goal.upgrade_all()
+    for pat in add_install:
+        if pat.startswith('@'):
+            raise SolverError("can't install groups (%s)" % pat)
+        sel = _selector(sack, pat)
+        if not sel.matches():
+            log.warn("couldn't add '%s': no package matches", pat)
+            continue
+        log.info("adding '%s' to upgrade", pat)
+        goal.install(select=sel)
+    if not goal.run(allow_uninstall=True):
+        for problem in goal.problems:
+            log.info("    %s", problem)
+        raise SolverError("libsolv found %u problems" % len(goal.problems))
+    return goal
+
+def _pkgtup(hpkg):
+    return (hpkg.name, hpkg.arch, str(hpkg.epoch), hpkg.version, hpkg.release)
+
+def _yumpo(yumobj, hpkg):
+    '''find the yum package object matching the given hawkey package'''
+    if hpkg.reponame == hawkey.SYSTEM_REPO_NAME:
+        found = yumobj.rpmdb.searchPkgTuple(_pkgtup(hpkg))
+    else:
+        found = [po for po in yumobj.pkgSack.searchPkgTuple(_pkgtup(hpkg))
+                 if po.repoid == hpkg.reponame]
+    if not found:
+        raise SolverError("can't find %s from %s in yum" %
+                          (hpkg, hpkg.reponame))
+    return found[0]
+
+def _replaced(goal, hpkg):
+    '''the installed package hpkg replaces (same name if possible), and
+    anything else it obsoletes'''
+    obs = list(goal.obsoleted_by_package(hpkg))
+    same = [o for o in obs if o.name == hpkg.name]
+    old = same[0] if same else (obs[0] if obs else None)
+    return old, [o for o in obs if o != old]
+
+def goal_to_tsinfo(yumobj, goal, callback=None):
+    '''
+    Add the result of goal to yumobj.tsInfo, like buildTransaction() would,
+    and report each member to callback (a DepsolveCallback).
+    '''
+    po = lambda hpkg: _yumpo(yumobj, hpkg)
+    added = [] # (txmbr, mode)
+    for hpkg in goal.list_upgrades():
+        old, obsoleted = _replaced(goal, hpkg)
+        txmbr = yumobj.tsInfo.addUpdate(po(hpkg), po(old) if old else None)
+        added.append((txmbr, 'u'))
+        for o in obsoleted:
+            txmbr.relatedto.append((po(o), 'obsoletes'))
+            yumobj.tsInfo.addObsoleted(po(o), txmbr.po)
+    for hpkg in goal.list_installs():
+        newpo = po(hpkg)
+        old, obsoleted = _replaced(goal, hpkg)
+        if old:
+            txmbr = yumobj.tsInfo.addObsoleting(newpo, po(old))
+            yumobj.tsInfo.addObsoleted(po(old), newpo)
+            added.append((txmbr, 'o'))
+        elif yumobj.allowedMultipleInstalls(newpo):
+            added.append((yumobj.tsInfo.addTrueInstall(newpo), 'i'))
+        else:
+            added.append((yumobj.tsInfo.addInstall(newpo), 'i'))
+        for o in obsoleted:
+            yumobj.tsInfo.addObsoleted(po(o), newpo)
+    for hpkg in goal.list_erasures():
+        added.append((yumobj.tsInfo.addErase(po(hpkg)), 'e'))
+    yumobj.po_with_problems = set()
+    if callback:
+        callback.start()
+        for txmbr, mode in added:
+            callback.pkgAdded(txmbr.pkgtup, mode)
+        for txmbr in yumobj.tsInfo.getMembers():
+            if txmbr.output_state == TS_UPDATED:
+                callback.pkgAdded(txmbr.pkgtup, 'ud')
+            elif txmbr.output_state == TS_OBSOLETED:
+                callback.pkgAdded(txmbr.pkgtup, 'od')
+        callback.end()
+
+def _load_sack(yumobj, cachedir, lazy_filelists=False):
+    if not lazy_filelists:
+        return make_sack(yumobj, cachedir)
+    sack = make_sack(yumobj, cachedir, filelists=False)
+    missing = missing_filedeps(sack)
+    if not missing:
+        log.debug("lazy filelists: never needed")
+        return sack
+    log.debug("lazy filelists: needed for %u file deps (e.g. %s), fetching",
+              len(missing), missing[0])
+    return make_sack(yumobj, cachedir)
+
+def hawkey_update_transaction(yumobj, cachedir, add_install=[],
+                              callback=None, lazy_filelists=False):
+    '''
+    Depsolve the upgrade with libsolv and fill in yumobj.tsInfo.
+    Raises SolverError if that doesn't work out (including hawkey or libsolv
+    errors, and metadata that can't be read), in which case tsInfo may be
+    partially filled in - throw it away.
+    '''
+    if not available():
+        raise SolverError("hawkey isn't installed")
+    log.info("looking for updates (with libsolv)")
+    try:
+        sack = _load_sack(yumobj, cachedir, lazy_filelists)
+        log.debug("hawkey sack has %u packages", len(sack))
+        goal = solve(yumobj, sack, add_install)
+        goal_to_tsinfo(yumobj, goal, callback)
+    except (hawkey.Exception, IOError, RuntimeError) as e:
+        raise SolverError("%s: %s" % (e.__class__.__name__, e))
+
+# --- comparing solvers
+
+def tsinfo_summary(tsInfo):
+    '''{pkgtup: output_state} for every member of tsInfo'''
+    return dict((t.pkgtup, t.output_state) for t in tsInfo.getMembers())
+
+def compare_solvers(yumobj, cachedir, add_install=[]):
+    '''
+    Depsolve with yum and with libsolv, and return a list of
+    (pkgtup, yum_state, hawkey_state) for each package where they disagree
+    (state is None if that solver left the package out entirely).
+    Leaves yumobj.tsInfo empty.
+    '''
+    yumobj.update()
+    for pat in add_install:
+        yumobj.install(pattern=pat)
+    yumobj.buildTransaction(unfinished_transactions_check=False)
+    yumsum = tsinfo_summary(yumobj.tsInfo)
+    del yumobj.tsInfo
+
+    hawkey_update_transaction(yumobj, cachedir, add_install)
+    hksum = tsinfo_summary(yumobj.tsInfo)
+    del yumobj.tsInfo
+
+    return [(tup, yumsum.get(tup), hksum.get(tup))
+            for tup in sorted(set(yumsum) | set(hksum))
+            if yumsum.get(tup) != hksum.get(tup)]
@@ -0,0 +1,163 @@
+# hdrcache.py - keep package headers in one file for quick re-reading
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A cache of RPM headers, so setting up the test transaction doesn't have to
+open every package again each time we run.
+
+The cache is a single file: a magic string, the length of the index, the
+index itself (JSON), and then the headers (as written by hdr.unload()).
+The index maps each package path to its stat() fingerprint (see
+util.stat_fingerprint), its checksum, and where its header is in the file.
+If the fingerprint or checksum of a package doesn't match, we ignore the
+cached header and read the package again.
+'''
+
+import os, json, struct
+from tempfile import mkstemp
+from .util import stat_fingerprint, mkdir_p, rm_f
+
+import rpm
+
+import logging
+log = logging.getLogger(__package__+".hdrcache")
+
+magic = "FEDUPHDR1\n"
+lenfmt = "<Q"
+
+class HeaderCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._index = dict() # path -> [dev, ino, size, mtime, csum, off, len]
+        self._dataoffset = 0
+        self._new = dict()   # path -> (fingerprint, csum, blob)
+        self._used = set()
+        self._inf = None
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def close(self):
+        if self._inf:
+            self._inf.close()
+            self._inf = None
+
+    def load(self):
+        self.close()
+        self._index = dict()
+        self._new = dict()
+        self._used = set()
+        try:
+            with open(self.filename, 'rb') as inf:
+                if inf.read(len(magic)) != magic:
+                    raise ValueError("bad magic")
+                size = struct.calcsize(lenfmt)
+                (indexlen,) = struct.unpack(lenfmt, inf.read(size))
+                self._index = json.loads(inf.read(indexlen))
+                self._dataoffset = len(magic) + size + indexlen
+        except (IOError, OSError):
+            pass
+        except (ValueError, struct.error):
+            log.info("ignoring corrupt header cache %s", self.filename)
+            self._index = dict()
+        log.debug("%u headers in %s", len(self._index), self.filename)
+
+    def _read_blob(self, entry):
+        if self._inf is None:
+            self._inf = open(self.filename, 'rb')
+        self._inf.seek(self._dataoffset + entry[5])
+        return self._inf.read(entry[6])
+
+    def get(self, path, csum=None):
+        '''
+        Return the cached header for path, or None if we don't have it or
+        the file (or its checksum, if given) has changed since we did.
+        '''
+        entry = self._index.get(path)
+        try:
+            fp = list(stat_fingerprint(os.stat(path)))
+        except OSError:
+            fp = None
+        if entry is None or entry[:4] != fp or \
+                (csum is not None and entry[4] != csum):
+            self.misses += 1
+            return None
+        try:
+            hdr = rpm.hdr(self._read_blob(entry))
+        except (IOError, OSError, rpm.error, TypeError) as e:
+            log.debug("can't load cached header for %s: %s", path, e)
+            self.misses += 1
+            return None
+        self._used.add(path)
+        self.hits += 1
+        return hdr
+
+    def add(self, path, hdr, csum=None):
+        try:
+            fp = list(stat_fingerprint(os.stat(path)))
+        except OSError:
+            return
+        self._new[path] = (fp, csum, hdr.unload())
+
+    def save(self):
+        '''
+        Write out the headers that were used or added since we loaded the
+        cache; anything else is dropped.
+        '''
+        if not self._new and self._used == set(self._index):
+            return
+        index = dict()
+        blobs = []
+        offset = 0
+        for path in sorted(self._used.union(self._new)):
+            if path in self._new:
+                fp, csum, blob = self._new[path]
+            else:
+                entry = self._index[path]
+                fp, csum = entry[:4], entry[4]
+                try:
+                    blob = self._read_blob(entry)
+                except (IOError, OSError):
+                    continue
+            index[path] = fp + [csum, offset, len(blob)]
+            blobs.append(blob)
+            offset += len(blob)
+        self._write(index, blobs)
+        self.load()
+
+    def _write(self, index, blobs):
+        dirname = os.path.dirname(self.filename)
+        try:
+            mkdir_p(dirname)
+            fd, tmpname = mkstemp(prefix='.hdrcache.', dir=dirname)
+        except (IOError, OSError) as e:
+            log.warn("couldn't write header cache %s: %s", self.filename, e)
+            return
+        try:
+            with os.fdopen(fd, 'wb') as outf:
+                indexdata = json.dumps(index)
+                outf.write(magic)
+                outf.write(struct.pack(lenfmt, len(indexdata)))
+                outf.write(indexdata)
+                for blob in blobs:
+                    outf.write(blob)
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            log.warn("couldn't write header cache %s: %s", self.filename, e)
+            rm_f(tmpname)
+            return
+        log.debug("wrote %u headers to %s", len(index), self.filename)
@@ -0,0 +1,113 @@
+# mdquery.py - quick questions about repos, answered from primary_db
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Answer a couple of simple questions ("does this repo have any packages?",
+"what provides X?") with indexed queries on each repo's primary sqlite DB,
+without making yum load the whole package sack.
+
+NOTE: this doesn't know about excludes (or anything else plugins do to the
+sack), so it's only suitable for sanity checks.
+'''
+
+import sqlite3
+from yum.Errors import RepoError
+from yum.misc import repo_gen_decompress
+
+import logging
+log = logging.getLogger(__package__+".mdquery")
+
+class NoPrimaryDB(Exception):
+    pass
+
+def primary_db_path(repo):
+    '''
+    Return the path to the uncompressed primary sqlite DB for repo,
+    downloading and/or decompressing it first if needed.
+    '''
+    try:
+        if 'primary_db' not in repo.repoXML.fileTypes():
+            raise NoPrimaryDB("%s has no primary_db" % repo.id)
+        filename = repo.retrieveMD('primary_db')
+        # NOTE: this is the same file yum will use when it loads the sack
+        return repo_gen_decompress(filename, 'primary.sqlite',
+                                   cached=repo.cache)
+    except (RepoError, IOError, OSError) as e:
+        raise NoPrimaryDB("%s: %s" % (repo.id, e))
+
+class PrimaryDB(object):
+    '''
+    a connection to a primary sqlite DB. we only ever read from it, but
+    python2's sqlite3 can't open files read-only, so the connection itself
+    is read-write. yum shares the same file, so don't write to it!
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        # make any accidental writes fail (sqlite 3.8+; ignored before that)
+        self._conn.execute("PRAGMA query_only = ON")
+
+    def close(self):
+        self._conn.close()
+
+    def empty(self):
+        cur = self._conn.execute("SELECT 1 FROM packages LIMIT 1")
+        return cur.fetchone() is None
+
+    def whatprovides(self, name):
+        '''return (name, arch, epoch, version, release) for each package that
+        provides name (ignoring versions)'''
+        cur = self._conn.execute(
+            "SELECT p.name, p.arch, p.epoch, p.version, p.release "
+            "FROM provides pr JOIN packages p ON pr.pkgKey = p.pkgKey "
+            "WHERE pr.name = ?", (name,))
+        return [tuple(row) for row in cur]
+
+class RepoQuery(object):
+    '''
+    Run queries against the primary DBs for the given repos.
+    Raises NoPrimaryDB if any of them doesn't have one (or it can't be
+    read), in which case the caller should just ask the sack instead.
+    '''
+    def __init__(self, repos):
+        self.repos = list(repos)
+        self._dbs = dict()
+
+    def _db(self, repo):
+        if repo.id not in self._dbs:
+            self._dbs[repo.id] = PrimaryDB(primary_db_path(repo))
+        return self._dbs[repo.id]
+
+    def close(self):
+        for db in self._dbs.values():
+            db.close()
+        self._dbs = dict()
+
+    def empty(self):
+        '''True if none of the repos have any packages'''
+        try:
+            return all(self._db(r).empty() for r in self.repos)
+        except sqlite3.Error as e:
+            raise NoPrimaryDB(str(e))
+
+    def whatprovides(self, name):
+        '''return a list of (repoid, pkgtup) for packages providing name'''
+        try:
+            return [(r.id, tup) for r in self.repos
+                                for tup in self._db(r).whatprovides(name)]
+        except sqlite3.Error as e:
+            raise NoPrimaryDB(str(e))
@@ -0,0 +1,186 @@
+# mirrors.py - remember which mirrors are fast (and which are broken)
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Mirror health statistics that persist between runs.
+
+yum tries mirrors in the order the mirrorlist/metalink gives them to us
+(failovermethod=priority), so every run has to find out the hard way which
+of them are slow or broken. MirrorStats keeps a moving average of latency
+and throughput for each mirror host, and how often it has failed, so the
+mirror lists can be sorted before we start downloading.
+
+Old data fades out: successes and failures are decayed with a half-life,
+and the less recent a host's data is, the closer its score gets to that of
+a host we know nothing about.
+'''
+
+import json, time, urlparse
+from threading import RLock
+from .util import write_json
+
+import logging
+log = logging.getLogger(__package__+".mirrors")
+
+def hostof(url):
+    return urlparse.urlsplit(url).netloc
+
+def median(values, default):
+    values = sorted(v for v in values if v)
+    return values[len(values)//2] if values else default
+
+class MirrorStats(object):
+    '''
+    Per-host latency, throughput and failure stats, saved as JSON.
+
+    Each entry maps a host to a dict with these keys:
+      latency: moving average of request latency (seconds)
+      rate: moving average of transfer throughput (bytes/sec)
+      ok, failed: decayed counts of successful/failed requests
+      time: when the entry was last updated
+    '''
+    halflife = 3*24*60*60 # seconds
+    alpha = 0.3           # weight of each new sample in the moving averages
+    refsize = 1024*1024   # scores are the expected time to fetch this much
+    failpenalty = 4.0     # a host that always fails scores 5x worse
+    default_latency = 0.5
+    default_rate = 1024*1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = dict()
+        self._dirty = False
+        self._lock = RLock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as inf:
+                self._entries = json.load(inf)
+        except (IOError, OSError):
+            self._entries = dict()
+        except ValueError:
+            log.info("ignoring corrupt mirror stats %s", self.filename)
+            self._entries = dict()
+        log.debug("loaded stats for %u mirrors from %s",
+                  len(self._entries), self.filename)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self.prune()
+            try:
+                write_json(self.filename, self._entries)
+            except (IOError, OSError) as e:
+                log.warn("couldn't write mirror stats %s: %s",
+                         self.filename, e)
+            else:
+                self._dirty = False
+
+    def _weight(self, entry, now=None):
+        '''how much the data in entry still counts (1.0 = brand new)'''
+        age = max(0, (now or time.time()) - entry['time'])
+        return 0.5 ** (age / self.halflife)
+
+    def _entry(self, host, now):
+        entry = self._entries.get(host)
+        if entry is None:
+            entry = dict(latency=None, rate=None, ok=0.0, failed=0.0,
+                         time=now)
+            self._entries[host] = entry
+        else:
+            w = self._weight(entry, now)
+            entry['ok'] *= w
+            entry['failed'] *= w
+            entry['time'] = now
+        self._dirty = True
+        return entry
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old + self.alpha * (new - old)
+
+    def record(self, url, latency=None, rate=None, ok=0, failed=0):
+        '''
+        record some results for the host in url: latency (in seconds) and
+        throughput (bytes/sec) for a request, and/or the number of requests
+        that succeeded and failed.
+        '''
+        host = hostof(url)
+        if not host:
+            return
+        with self._lock:
+            entry = self._entry(host, time.time())
+            if latency is not None:
+                entry['latency'] = self._average(entry['latency'], latency)
+            if rate:
+                entry['rate'] = self._average(entry['rate'], rate)
+            entry['ok'] += ok
+            entry['failed'] += failed
+
+    def record_failure(self, url):
+        self.record(url, failed=1)
+
+    def score(self, url, now=None, neutral=None):
+        '''
+        Expected seconds to fetch refsize bytes from url's host, plus a
+        penalty for failures. Lower is better.
+        '''
+        if neutral is None:
+            neutral = self._neutral()
+        entry = self._entries.get(hostof(url))
+        if entry is None:
+            return neutral
+        latency = entry['latency'] or self._typical('latency')
+        rate = entry['rate'] or self._typical('rate')
+        w = self._weight(entry, now)
+        failed, ok = entry['failed'] * w, entry['ok'] * w
+        score = latency + self.refsize / rate
+        score *= 1 + self.failpenalty * failed / (failed + ok + 1)
+        # fade towards the neutral score as the data gets older
+        return neutral + (score - neutral) * w
+
+    def _typical(self, key):
+        default = getattr(self, 'default_'+key)
+        return median((e[key] for e in self._entries.values()), default)
+
+    def _neutral(self):
+        '''the score for a host we don't know anything about'''
+        return self._typical('latency') + self.refsize / self._typical('rate')
+
+    def rank(self, urls):
+        '''
+        Return urls sorted best-first. Hosts we have no data for score
+        like a typical host; ties keep their original order.
+        '''
+        now = time.time()
+        with self._lock:
+            neutral = self._neutral()
+            scores = dict((u, self.score(u, now, neutral)) for u in urls)
+        return sorted(urls, key=lambda u: scores[u])
+
+    def prune(self, maxage=None):
+        '''forget hosts we haven't heard from in a long time'''
+        if maxage is None:
+            maxage = 10 * self.halflife
+        cutoff = time.time() - maxage
+        for host, entry in self._entries.items():
+            if entry['time'] < cutoff:
+                del self._entries[host]
+                self._dirty = True
@@ -0,0 +1,137 @@
+# objstore.py - content-addressed package store, shared by all repos
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A store of package files named by their checksum, like:
+
+  $cachedir/objects/sha256/ab/abcdef0123...
+
+The same RPM often turns up in several repos (the install repo and the
+'fedora' repo, for instance), and yum would download and keep a separate
+copy for each repo's pkgdir. Instead, every verified package gets
+hardlinked into the store, and before downloading anything we check the
+store for a package with the same checksum and just link it into place.
+
+Objects whose only remaining link is the one in the store aren't used by
+any repo anymore, and get removed by prune().
+'''
+
+import os, errno
+from .util import mkdir_p, rm_f, listdir
+
+import logging
+log = logging.getLogger(__package__+".objstore")
+
+class ObjectStore(object):
+    def __init__(self, topdir):
+        self.topdir = topdir
+
+    def path(self, csum_type, csum):
+        return os.path.join(self.topdir, csum_type, csum[:2], csum)
+
+    def lookup(self, csum_type, csum):
+        '''return the path to the object with the given checksum, or None'''
+        obj = self.path(csum_type, csum)
+        return obj if os.path.exists(obj) else None
+
+    def _link(self, src, dest):
+        '''hardlink src to dest, atomically replacing dest if it exists'''
+        tmp = dest + '.objtmp'
+        rm_f(tmp)
+        os.link(src, tmp)
+        os.rename(tmp, dest)
+
+    def link_into(self, csum_type, csum, dest):
+        '''
+        If we have an object with the given checksum, hardlink it to dest and
+        return its path. Returns None if there's no such object or it can't
+        be linked (e.g. it's on a different filesystem).
+        '''
+        obj = self.lookup(csum_type, csum)
+        if obj is None:
+            return None
+        try:
+            mkdir_p(os.path.dirname(dest))
+            self._link(obj, dest)
+        except OSError as e:
+            log.debug("can't link %s to %s: %s", obj, dest, e)
+            return None
+        log.debug("%s found in object store", os.path.basename(dest))
+        return obj
+
+    def add(self, path, csum_type, csum):
+        '''
+        Put the (verified!) file at path into the store. If there's already
+        an identical object, path is replaced with a link to it.
+        Returns the object's path, or None if it couldn't be added.
+        '''
+        obj = self.path(csum_type, csum)
+        try:
+            if not os.path.exists(obj):
+                mkdir_p(os.path.dirname(obj))
+                os.link(path, obj)
+            elif not os.path.samefile(obj, path):
+                log.debug("replacing %s with a link to %s", path, obj)
+                self._link(obj, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                log.info("can't add %s to object store: %s", path, e)
+            return None
+        return obj
+
+    def objects(self):
+        if not os.path.isdir(self.topdir):
+            return
+        for typedir in listdir(self.topdir):
+            for subdir in listdir(typedir):
+                for obj in listdir(subdir):
+                    yield obj
+
+    def prune(self):
+        '''remove objects that nothing else links to'''
+        removed = 0
+        for obj in self.objects():
+            if os.stat(obj).st_nlink == 1:
+                rm_f(obj)
+                removed += 1
+        if removed:
+            log.info("removed %u unused objects from object store", removed)
+
+    def stats(self, pkgdirs):
+        '''
+        Return a dict with the number of objects, their total size, the
+        number of packages in pkgdirs that link to them, and the bytes saved
+        by sharing them (compared to keeping a copy for each link).
+        '''
+        inodes = dict()
+        for obj in self.objects():
+            st = os.stat(obj)
+            inodes[(st.st_dev, st.st_ino)] = [st.st_size, 0]
+        for d in pkgdirs:
+            if not os.path.isdir(d):
+                continue
+            for f in listdir(d):
+                if not f.endswith('.rpm'):
+                    continue
+                st = os.stat(f)
+                if (st.st_dev, st.st_ino) in inodes:
+                    inodes[(st.st_dev, st.st_ino)][1] += 1
+        return dict(objects=len(inodes),
+                    size=sum(size for size, links in inodes.values()),
+                    links=sum(links for size, links in inodes.values()),
+                    saved=sum(size*(links-1) for size, links in
+                              inodes.values() if links > 1))
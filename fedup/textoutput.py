@@ -123,6 +123,7 @@ class DownloadCallback(DownloadCallbackBase):
     def __init__(self, tty=sys.stderr):
         DownloadCallbackBase.__init__(self)
         self.bar = SimpleProgress(10, tty=tty, prefix=_("verify local files"))
+        self.fetchbar = None
 
     def verify(self, amount, total, filename, data):
         DownloadCallbackBase.verify(self, amount, total, filename, data)
@@ -132,6 +133,17 @@ class DownloadCallback(DownloadCallbackBase):
         if amount == total:
             self.bar.finish()
 
+    def fetch(self, amount, total, filename, data):
+        DownloadCallbackBase.fetch(self, amount, total, filename, data)
+        shortname = os.path.basename(filename)
+        if self.fetchbar is None or self.fetchbar.prefix != shortname:
+            self.fetchbar = SimpleProgress(total, tty=self.bar.tty,
+                                           prefix=shortname)
+        self.fetchbar.update(amount)
+        if amount == total:
+            self.fetchbar.finish()
+            self.fetchbar = None
+
     def userconfirm(self):
         return YumOutput().userconfirm()
 
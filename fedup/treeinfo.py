@@ -185,6 +185,12 @@ class Treeinfo(RawConfigParser):
             self.get('general', f)
         # TODO check for checksums for all images
 
+    def get_checksum(self, relpath):
+        '''return (algo, checksum) for relpath from the [checksums] section'''
+        val = self.get('checksums', relpath)
+        algo, checksum = val.split(':',1)
+        return algo, checksum
+
     def checkfile(self, filename, relpath):
         '''
         Check the given file against the info in [checksum].
@@ -194,8 +200,7 @@ class Treeinfo(RawConfigParser):
         i.e. the value from the [images-*] section (and the key in the
         [checksums] section)
         '''
-        val = self.get('checksums', relpath)
-        algo, checksum = val.split(':',1)
+        algo, checksum = self.get_checksum(relpath)
         try:
             return checksum == hexdigest(filename, algo)
         except IOError:
@@ -22,14 +22,17 @@
 import rpm
 from rpm._rpm import ts as TransactionSetCore
 
-import os, tempfile
-from threading import Thread
+import os, time, tempfile, json, hashlib
+from threading import Thread, local
+from multiprocessing.pool import ThreadPool
 
 import logging
 log = logging.getLogger(__package__+'.upgrade')
 
 from . import _
-from .util import df, hrsize
+from .util import df, hrsize, fadvise, POSIX_FADV_WILLNEED
+from .util import stat_fingerprint
+from .conflicts import find_conflicts_parallel
 
 class TransactionSet(TransactionSetCore):
     flags = TransactionSetCore._flags
@@ -50,20 +53,70 @@ class TransactionSet(TransactionSetCore):
         return [p for p in self.problems()
                   if p.type in (rpm.RPMPROB_CONFLICT, rpm.RPMPROB_REQUIRES)]
 
-    def add_install(self, path, key=None, upgrade=False):
+    def add_install(self, path, key=None, upgrade=False, header=None):
         log.debug('add_install(%s, %s, upgrade=%s)', path, key, upgrade)
         if key is None:
             key = path
-        with open(path) as fileobj:
-            retval, header = self.hdrFromFdno(fileobj)
-        if retval != rpm.RPMRC_OK:
-            raise rpm.error("error reading package header")
+        if header is None:
+            with open(path) as fileobj:
+                retval, header = self.hdrFromFdno(fileobj)
+            if retval != rpm.RPMRC_OK:
+                raise rpm.error("error reading package header")
         if not self.addInstall(header, key, upgrade):
             raise rpm.error("adding package to transaction failed")
 
     def __del__(self):
         self.closeDB()
 
+class HeaderReader(object):
+    '''
+    Read package headers with a pool of threads, so the disk has a bunch of
+    reads to work on at once instead of one at a time. Each thread gets its
+    own (read-only) TransactionSet to read headers with.
+    '''
+    # tell the kernel we'll want this much of each file right away; that's
+    # enough for the header of nearly any package
+    readahead = 512*1024
+
+    def __init__(self, root='/', vsflags=0, workers=8):
+        self.root = root
+        self.vsflags = vsflags
+        self.workers = max(1, workers)
+        self._local = local()
+
+    def read(self, path):
+        '''
+        Return (path, header, error) for path. error is an exception to
+        raise in the caller (rpm.error for a bad header), or None.
+        '''
+        ts = getattr(self._local, 'ts', None)
+        if ts is None:
+            ts = self._local.ts = TransactionSetCore(self.root, self.vsflags)
+        try:
+            with open(path) as fileobj:
+                fadvise(fileobj.fileno(), 0, self.readahead,
+                        POSIX_FADV_WILLNEED)
+                retval, header = ts.hdrFromFdno(fileobj)
+            if retval != rpm.RPMRC_OK:
+                raise rpm.error("error reading package header")
+        except (rpm.error, IOError, OSError) as e:
+            return path, None, e
+        return path, header, None
+
+    def imap(self, paths):
+        '''yield read(path) for each of paths, in order'''
+        paths = list(paths)
+        pool = ThreadPool(min(self.workers, len(paths)) or 1)
+        try:
+            results = pool.imap(self.read, paths)
+            for path in paths:
+                # NOTE: next() without a timeout can't be interrupted by Ctrl-C
+                yield results.next(0xffff)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
 probtypes = { rpm.RPMPROB_NEW_FILE_CONFLICT : _('file conflicts'),
               rpm.RPMPROB_FILE_CONFLICT : _('file conflicts'),
               rpm.RPMPROB_OLDPACKAGE: _('older package(s)'),
@@ -164,6 +217,80 @@ class TransactionError(Exception):
         self.problems = problems
         self.summaries = summarize_problems(problems)
 
+# --- remembering test results
+
+class SavedProblemSummary(ProblemSummary):
+    '''a ProblemSummary from a previous run (see load_test_result)'''
+    def __init__(self, desc, details):
+        self.type = None
+        self.problems = []
+        self.desc = desc
+        self.details = details
+
+    def format_details(self):
+        return self.details
+
+class SavedTransactionError(TransactionError):
+    def __init__(self, summaries):
+        self.problems = []
+        self.summaries = summaries
+
+def rpmdb_fingerprint(root='/'):
+    '''(number of headers, cookie) for the rpmdb in root'''
+    ts = rpm.TransactionSet(root)
+    try:
+        count = ts.dbMatch().count()
+        if hasattr(ts, 'dbCookie'):
+            cookie = ts.dbCookie()
+        else:
+            # older rpm; settle for noticing that the db has been written to
+            dbpath = os.path.join(root, rpm.expandMacro('%_dbpath').lstrip('/'))
+            st = os.stat(os.path.join(dbpath, 'Packages'))
+            cookie = ':'.join(str(i) for i in stat_fingerprint(st))
+    finally:
+        ts.closeDB()
+    return count, cookie
+
+def transaction_fingerprint(checksums, root='/', level='full'):
+    '''
+    a checksum of the things that determine the test transaction's result:
+    the package files (and their checksums, given as a path->csum dict),
+    the contents of the rpmdb, and how thorough the test is.
+    '''
+    count, cookie = rpmdb_fingerprint(root)
+    inputs = dict(pkgs=sorted(checksums.items()), rpmdb=[count, cookie],
+                  level=level)
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def save_test_result(conf, fingerprint, probs, rv):
+    '''record the result of a test transaction in conf (a Config)'''
+    summaries = [[s.desc, s.format_details() if s.details else []]
+                 for s in probs.summaries] if probs else []
+    conf.set("test", "fingerprint", fingerprint)
+    conf.set("test", "result", rv)
+    conf.set("test", "problems", json.dumps(summaries))
+
+def load_test_result(conf, fingerprint):
+    '''
+    return (probs, rv) from the last test transaction if it passed and its
+    fingerprint matches, or None if not (or there wasn't one). Failures are
+    never reused, since the fingerprint doesn't cover everything that can
+    make a test fail (free disk space, for one).
+    '''
+    if conf.get("test", "fingerprint") != fingerprint:
+        return None
+    try:
+        rv = int(conf.get("test", "result"))
+        if rv != 0:
+            return None
+        summaries = [SavedProblemSummary(desc, details) for desc, details
+                     in json.loads(conf.get("test", "problems"))]
+    except (TypeError, ValueError) as e:
+        log.debug("can't load saved test result: %s", e)
+        return None
+    probs = SavedTransactionError(summaries) if summaries else None
+    return probs, rv
+
 def pipelogger(pipe, level=logging.INFO):
     logger = logging.getLogger(__package__+".rpm")
     logger.info("opening pipe")
@@ -176,6 +303,12 @@ def pipelogger(pipe, level=logging.INFO):
         logger.info("got EOF")
     logger.info("exiting")
 
+# how thorough the transaction test is, from quickest to slowest:
+#   deps:      dependency check (ts.check()) only
+#   conflicts: deps, plus looking for file conflicts in the package headers
+#   full:      deps, plus rpm's test transaction
+test_levels = ('deps', 'conflicts', 'full')
+
 logging_to_rpm = {
     logging.DEBUG:      rpm.RPMLOG_DEBUG,
     logging.INFO:       rpm.RPMLOG_INFO,
@@ -189,25 +322,67 @@ class RPMUpgrade(object):
         self.root = root
         self.ts = None
         self.logpipe = None
+        self.header_workers = 8
+        self.conflict_workers = 1 # >1 splits the check over processes
+        self.hdrcache = None # a HeaderCache, if we want one
+        self.headers = []
+        self.timings = dict() # test level -> seconds
         rpm.setVerbosity(logging_to_rpm[rpmloglevel])
         if logpipe:
             self.logpipe = self.openpipe()
 
-    def setup_transaction(self, pkgfiles, check_fatal=False):
+    def _headers(self, pkgfiles, checksums):
+        '''
+        yield (pkg, header, error) for each of pkgfiles, in order, using
+        the header cache where we can and reading the rest in parallel.
+        '''
+        pkgfiles = list(pkgfiles)
+        cached = dict()
+        if self.hdrcache:
+            for pkg in pkgfiles:
+                hdr = self.hdrcache.get(pkg, checksums.get(pkg))
+                if hdr is not None:
+                    cached[pkg] = hdr
+            log.debug("%u of %u headers cached", len(cached), len(pkgfiles))
+        reader = HeaderReader(self.root, rpm._RPMVSF_NOSIGNATURES,
+                              workers=self.header_workers)
+        results = reader.imap(p for p in pkgfiles if p not in cached)
+        for pkg in pkgfiles:
+            if pkg in cached:
+                yield pkg, cached[pkg], None
+                continue
+            pkg, header, err = next(results)
+            if self.hdrcache and header is not None:
+                self.hdrcache.add(pkg, header, checksums.get(pkg))
+            yield pkg, header, err
+
+    def setup_transaction(self, pkgfiles, check_fatal=False, checksums={}):
+        '''
+        Set up the upgrade transaction for pkgfiles. checksums can map
+        package paths to their checksums, for checking cached headers.
+        '''
         log.debug("starting")
         # initialize a transaction set
         self.ts = TransactionSet(self.root, rpm._RPMVSF_NOSIGNATURES)
         if self.logpipe:
             self.ts.scriptFd = self.logpipe.fileno()
         # populate the transaction set
-        for pkg in pkgfiles:
+        self.headers = []
+        for pkg, header, err in self._headers(pkgfiles, checksums):
             try:
-                self.ts.add_install(pkg, upgrade=True)
+                if err:
+                    raise err
+                self.ts.add_install(pkg, upgrade=True, header=header)
+                self.headers.append(header)
             except rpm.error as e:
                 log.warn('error adding pkg: %s', e)
                 # TODO: error callback
+        if self.hdrcache:
+            self.hdrcache.save()
         log.debug('ts.check()')
+        start = time.time()
         problems = self.ts.check() or []
+        self.timings['deps'] = time.time() - start
         if problems:
             log.info("problems with transaction check:")
             for p in problems:
@@ -255,12 +430,46 @@ class RPMUpgrade(object):
             log.info("ts completed with problems - code %u", rv)
         return rv
 
-    def test_transaction(self, callback):
-        self.ts.flags = rpm.RPMTRANS_FLAG_TEST
+    def remaining_instances(self):
+        '''rpmdb instances of installed packages this transaction keeps'''
+        removed = set(te.DBOffset() for te in self.ts
+                      if te.Type() == rpm.TR_REMOVED)
+        ts = rpm.TransactionSet(self.root)
         try:
-            return self.run_transaction(callback)
+            mi = ts.dbMatch()
+            return [mi.instance() for h in mi if mi.instance() not in removed]
+        finally:
+            ts.closeDB()
+
+    def check_conflicts(self):
+        '''raise TransactionError if the new packages have file conflicts'''
+        problems = find_conflicts_parallel(self.headers,
+                                           self.remaining_instances(),
+                                           self.root, self.conflict_workers)
+        if problems:
+            log.info("ts has %u file conflicts", len(problems))
+            raise TransactionError(problems=problems)
+        return 0
+
+    def test_transaction(self, callback, level='full'):
+        '''
+        Test the transaction as thoroughly as level says (see test_levels).
+        The dependency check was already done by setup_transaction().
+        '''
+        start = time.time()
+        try:
+            if level == 'deps':
+                return 0
+            elif level == 'conflicts':
+                return self.check_conflicts()
+            self.ts.flags = rpm.RPMTRANS_FLAG_TEST
+            try:
+                return self.run_transaction(callback)
+            finally:
+                self.ts.flags &= ~rpm.RPMTRANS_FLAG_TEST
         finally:
-            self.ts.flags &= ~rpm.RPMTRANS_FLAG_TEST
+            if level != 'deps':
+                self.timings[level] = time.time() - start
 
     def __del__(self):
         if self.logpipe:
@@ -17,9 +17,9 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
-import os, struct
+import os, struct, json
 from shutil import rmtree
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 
 import logging
 log = logging.getLogger(__package__+".util")
@@ -32,6 +32,25 @@ try:
 except (ImportError, AttributeError, OSError):
     is_selinux_enabled = lambda: False
 
+try:
+    from ctypes import cdll, c_int, c_int64
+    libc = cdll.LoadLibrary("libc.so.6")
+    # NOTE: posix_fadvise takes off_t, which is 32 bits on 32-bit arches;
+    # posix_fadvise64 takes a 64-bit off64_t everywhere.
+    _posix_fadvise = libc.posix_fadvise64
+    _posix_fadvise.argtypes = [c_int, c_int64, c_int64, c_int]
+except (ImportError, AttributeError, OSError):
+    _posix_fadvise = None
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+
+def fadvise(fd, offset, length, advice):
+    '''posix_fadvise(), if we have it. It's only a hint, so errors are
+    ignored.'''
+    if _posix_fadvise:
+        _posix_fadvise(fd, offset, length, advice)
+
 def listdir(d):
     for f in os.listdir(d):
         yield os.path.join(d, f)
@@ -62,6 +81,21 @@ def rm_rf(d):
     else:
         rm_f(d)
 
+def write_json(filename, data):
+    '''write data to filename as JSON, atomically (via a tempfile + rename)
+    so readers never see a half-written file.'''
+    dirname = os.path.dirname(filename)
+    mkdir_p(dirname)
+    fd, tmpname = mkstemp(prefix='.'+os.path.basename(filename)+'.',
+                          dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(data, outf)
+        os.rename(tmpname, filename)
+    except:
+        rm_f(tmpname)
+        raise
+
 def kernelver(filename):
     '''read the version number out of a vmlinuz file.'''
     # this algorithm came from /usr/share/magic
@@ -77,6 +111,11 @@ def kernelver(filename):
     version, spc, rest = uname.partition(' ')
     return version
 
+def stat_fingerprint(st):
+    '''(dev, inode, size, mtime_ns) for the given stat() result. If any of
+    these change, the file's contents may have changed too.'''
+    return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 1000000000))
+
 def df(mnt, reserved=False):
     s = os.statvfs(mnt)
     return s.f_bsize * (s.f_bfree if reserved else s.f_bavail)
@@ -0,0 +1,289 @@
+# verify.py - parallel verification of cached packages
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, signal, json
+from threading import Condition, BoundedSemaphore, local
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from yum.misc import checksum
+from yum.Errors import MiscError
+from rpmUtils.transaction import initReadOnlyTransaction
+from rpmUtils.miscutils import checkSig
+from .util import write_json, stat_fingerprint
+
+import logging
+log = logging.getLogger(__package__+".verify")
+
+def _init_worker():
+    # let the parent handle Ctrl-C; it'll terminate the pool for us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _checksum_file(args):
+    '''checksum a single file. runs in a worker process.'''
+    csum_type, filename, size = args
+    try:
+        if size and os.path.getsize(filename) != int(size):
+            return None
+        return checksum(csum_type, filename, datasize=size)
+    except (MiscError, OSError):
+        return None
+
+def mark_verified(po, st=None):
+    '''Seed yum's verifyLocalPkg() cache so it won't checksum the file again.
+    (verifyLocalPkg() trusts the cache as long as size and mtime match.)'''
+    if st is None:
+        st = os.stat(po.localPkg())
+    po._verify_local_pkg_cache = st
+
+def verify_local_pkgs(pkgs, workers=None, cache=None):
+    '''
+    Checksum the local files for the given packages using a pool of worker
+    processes. Yields (po, ok) tuples in the same order as pkgs, as soon
+    as each result is available.
+
+    If cache is a VerifyCache, files that it already knows about are
+    skipped, and newly-verified files are added to it.
+
+    Packages that pass are marked verified (see mark_verified), so yum won't
+    checksum them again in _downloadPackages().
+    '''
+    pkgs = list(pkgs)
+    if not pkgs:
+        return
+    # check the cache first; only hash the files it doesn't know about
+    cached = dict()
+    jobs = []
+    for po in pkgs:
+        (csum_type, csum) = po.returnIdSum()
+        st = cache.lookup(po.localPkg(), csum_type, csum) if cache else None
+        if st is not None:
+            cached[po] = st
+        else:
+            jobs.append((csum_type, po.localPkg(), po.packagesize))
+    log.debug("%u of %u packages already verified", len(cached), len(pkgs))
+    if not jobs:
+        for po in pkgs:
+            mark_verified(po, cached[po])
+            yield po, True
+        return
+    if workers is None:
+        workers = cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+    log.debug("verifying %u packages with %u workers", len(jobs), workers)
+    pool = Pool(workers, _init_worker)
+    try:
+        results = pool.imap(_checksum_file, jobs)
+        for po in pkgs:
+            if po in cached:
+                mark_verified(po, cached[po])
+                yield po, True
+                continue
+            # NOTE: next() without a timeout can't be interrupted by Ctrl-C
+            filesum = results.next(0xffff)
+            (csum_type, csum) = po.returnIdSum()
+            ok = (filesum is not None and filesum == csum)
+            if ok:
+                try:
+                    mark_verified(po)
+                except OSError:
+                    ok = False
+            if ok and cache:
+                cache.add(po.localPkg(), csum_type, csum,
+                          po._verify_local_pkg_cache)
+            elif not ok:
+                log.debug("%s failed verification", po.localPkg())
+                if cache:
+                    cache.discard(po.localPkg())
+            yield po, ok
+        pool.close()
+    finally:
+        # if we're bailing out early (exception, KeyboardInterrupt, etc.)
+        # this kills the workers; otherwise they're already done.
+        pool.terminate()
+        pool.join()
+
+class VerifyCache(object):
+    '''
+    A persistent index of files we've already checksummed, so we don't have
+    to read thousands of unchanged RPMs again every time fedup runs.
+
+    Each entry maps a path to the file's fingerprint (device, inode, size,
+    mtime) plus the checksum type and the checksum that was verified.
+    If any part of the fingerprint changes, the entry is thrown out.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = dict()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as inf:
+                self._entries = json.load(inf)
+        except (IOError, OSError):
+            self._entries = dict()
+        except ValueError:
+            log.info("ignoring corrupt verify cache %s", self.filename)
+            self._entries = dict()
+        log.debug("loaded %u entries from %s",
+                  len(self._entries), self.filename)
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            write_json(self.filename, self._entries)
+        except (IOError, OSError) as e:
+            log.warn("couldn't write verify cache %s: %s", self.filename, e)
+        else:
+            self._dirty = False
+
+    def lookup(self, path, csum_type, csum):
+        '''
+        If path has already been verified to have the given checksum, and it
+        hasn't changed since then, return its stat() result. Otherwise return
+        None (and drop the entry, if it's stale).
+        '''
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(path)
+            return None
+        if entry[:4] != list(stat_fingerprint(st)):
+            log.debug("%s changed since last verified", path)
+            self.discard(path)
+            return None
+        if entry[4:] != [csum_type, csum]:
+            return None
+        return st
+
+    def add(self, path, csum_type, csum, st=None):
+        if st is None:
+            st = os.stat(path)
+        self._entries[path] = list(stat_fingerprint(st)) + [csum_type, csum]
+        self._dirty = True
+
+    def discard(self, path):
+        if self._entries.pop(path, None) is not None:
+            self._dirty = True
+
+    def prune(self):
+        '''drop entries for files that have been removed or changed'''
+        for path, entry in self._entries.items():
+            try:
+                fp = list(stat_fingerprint(os.stat(path)))
+            except OSError:
+                fp = None
+            if entry[:4] != fp:
+                self.discard(path)
+
+# --- parallel signature checking
+
+_sigcheck_tls = local()
+def _init_sigcheck_worker(root):
+    _sigcheck_tls.ts = initReadOnlyTransaction(root=root)
+
+def _sigcheck_file(filename):
+    '''check a package signature. runs in a worker thread.'''
+    try:
+        return checkSig(_sigcheck_tls.ts, filename)
+    except Exception:
+        # the callback has to run no matter what, or submit() will hang
+        return None
+
+class SigCheckPool(object):
+    '''
+    Check package signatures in a pool of worker threads, starting as soon
+    as each package is submitted.
+
+    NOTE: these are threads, not processes: we get here with yum's rpmdb
+    open and threads running, and a forked child can't safely touch either
+    (or open the rpmdb again). rpm reads and checks each package with the
+    GIL released, so the threads still run in parallel. Each one gets its
+    own TransactionSet.
+
+    The workers only ever say "this signature is OK" or "it isn't";
+    anything other than OK needs to go through yum's sigCheckPkg() in the
+    main process, since that's what handles key imports and error messages.
+
+    At most maxpending checks are queued at once; submit() blocks until a
+    slot opens up. After the first hard failure (damaged or unsigned
+    package) nothing else gets submitted.
+    '''
+    # checkSig() return codes that no key import is going to fix
+    hard_failures = (2, 4)
+
+    def __init__(self, root='/', workers=None, maxpending=None):
+        if workers is None:
+            workers = cpu_count()
+        workers = max(1, workers)
+        if maxpending is None:
+            maxpending = workers * 4
+        log.debug("starting %u signature check workers", workers)
+        self._pool = ThreadPool(workers, _init_sigcheck_worker, (root,))
+        self._slots = BoundedSemaphore(maxpending)
+        self._cond = Condition()
+        self._results = dict()
+        self._pending = set()
+        self.failed = None
+
+    def submit(self, po):
+        with self._cond:
+            if self._pool is None or self.failed:
+                return
+            if po in self._results or po in self._pending:
+                return
+            self._pending.add(po)
+        self._slots.acquire()
+        self._pool.apply_async(_sigcheck_file, (po.localPkg(),),
+                               callback=lambda r: self._done(po, r))
+
+    def _done(self, po, result):
+        # NOTE: this runs in the pool's result-handler thread
+        self._slots.release()
+        with self._cond:
+            self._pending.discard(po)
+            self._results[po] = result
+            if result in self.hard_failures and self.failed is None:
+                log.info("%s failed signature check", po)
+                self.failed = po
+            self._cond.notify_all()
+
+    def result(self, po):
+        '''
+        Wait for the result for po and return the checkSig() code, or None if
+        po was never submitted (or the check couldn't be done).
+        '''
+        with self._cond:
+            while po in self._pending:
+                self._cond.wait(0xffff) # timeout so Ctrl-C still works
+            return self._results.get(po)
+
+    def close(self):
+        '''stop all the workers, discarding any unfinished checks'''
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        with self._cond:
+            self._pending.clear()
+            self._cond.notify_all()